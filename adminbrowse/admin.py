@@ -1,9 +1,428 @@
+import datetime
+from decimal import Decimal
+from threading import Lock
+
 from django.contrib.admin import ModelAdmin
-from django.db.models import FieldDoesNotExist, ForeignKey, URLField
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db.models import FieldDoesNotExist, ForeignKey, URLField, Q
+from django.db.models.sql.constants import LOOKUP_SEP
+from django.utils import simplejson
 from django.conf import settings
 
 from adminbrowse.related import link_to_change
 from adminbrowse.columns import link_to_url
+from adminbrowse.paginators import (EXACT, ESTIMATED, CountPaginator,
+                                    capped_count, estimate_count)
+
+# Query string parameters for keyset pagination cursors.
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+
+def select_related_plan(columns):
+    """
+    Return a sorted tuple of the `select_related()` lookups needed by the
+    given changelist columns. Each column may list lookups in its
+    `select_related` attribute; lookups that are already implied by a longer
+    one (such as 'author' by 'author__publisher') are dropped.
+
+    """
+    paths = set()
+    for column in columns:
+        paths.update(getattr(column, 'select_related', None) or ())
+    return tuple(sorted(path for path in paths if not
+                        [other for other in paths
+                         if other.startswith(path + '__')]))
+
+def annotation_plan(columns):
+    """
+    Return a dictionary of the aggregate annotations needed by the given
+    changelist columns, taken from each column's `annotations` attribute.
+
+    """
+    annotations = {}
+    for column in columns:
+        annotations.update(getattr(column, 'annotations', None) or {})
+    return annotations
+
+def extra_select_plan(columns):
+    """
+    Return a dictionary of the extra SQL selections needed by the given
+    changelist columns, taken from each column's `extra_select` attribute,
+    for passing to `QuerySet.extra(select=...)`.
+
+    """
+    select = {}
+    for column in columns:
+        select.update(getattr(column, 'extra_select', None) or {})
+    return select
+
+def only_plan(model, columns):
+    """
+    Return a sorted tuple of the names of the fields of `model` needed to
+    render the given changelist columns, for passing to `QuerySet.only()`.
+    Returns None if the needs of any column are unknown, such as a method
+    name or a column without `required_fields`.
+
+    """
+    fields = set()
+    for column in columns:
+        if isinstance(column, basestring):
+            if column == 'action_checkbox':
+                continue
+            try:
+                field, model_, direct, m2m = \
+                    model._meta.get_field_by_name(column)
+            except FieldDoesNotExist:
+                return None
+            if not direct:
+                return None
+            if not m2m:
+                fields.add(field.name)
+        else:
+            required = getattr(column, 'required_fields', None)
+            if required is None:
+                return None
+            fields.update(required)
+            version = getattr(column, 'cell_cache_version', None)
+            if version is not None:
+                fields.add(version)
+    return tuple(sorted(fields))
+
+def keyset_lookup(model, order_field):
+    """
+    Return the lookup to order and filter a `QuerySet` of `model` by for
+    keyset pagination on `order_field`, and a list of the attributes to
+    follow from an object to get its value. Returns None if `order_field`
+    can't be used: it must be a path of direct, non-null fields, and may
+    end with a `ForeignKey` to a model without a default ordering. In
+    particular, annotations such as the counts of sortable count columns
+    can't be used, and the changelist falls back to offset pagination.
+
+    """
+    opts = model._meta
+    names = order_field.split(LOOKUP_SEP)
+    attrs = []
+    for i, name in enumerate(names):
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field, model_, direct, m2m = opts.get_field_by_name(name)
+            except FieldDoesNotExist:
+                return None
+            if not direct or m2m:
+                return None
+        if field.null:
+            return None
+        last = i == len(names) - 1
+        if field.rel is None:
+            if not last:
+                return None
+            attrs.append(field.attname)
+        elif last:
+            # Ordering by a relation orders by the related model's default
+            # ordering, or by the foreign key if it has none.
+            if field.rel.to._meta.ordering:
+                return None
+            attrs.append(field.attname)
+            return order_field + LOOKUP_SEP + 'pk', attrs
+        else:
+            attrs.append(field.name)
+            opts = field.rel.to._meta
+    if len(names) == 1 and field.primary_key:
+        return 'pk', attrs
+    return order_field, attrs
+
+def _encode_keyset_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError("%r is not JSON serializable" % value)
+
+def encode_cursor(values):
+    """Return the string for a keyset pagination cursor at `values`."""
+    return simplejson.dumps(list(values), default=_encode_keyset_value,
+                            separators=(',', ':'))
+
+def decode_cursor(cursor, length):
+    """
+    Return the list of `length` values in the keyset pagination `cursor`,
+    raising `IncorrectLookupParameters` if it isn't valid.
+
+    """
+    try:
+        values = simplejson.loads(cursor)
+    except ValueError:
+        raise IncorrectLookupParameters
+    if not isinstance(values, list) or len(values) != length:
+        raise IncorrectLookupParameters
+    return values
+
+
+class ChangeListPlan(object):
+    """
+    The `list_display` columns and `QuerySet` adjustments that
+    `AutoBrowseModelAdmin` uses to render a changelist. Plans are shared by
+    every admin instance with the same class, model, `list_display` and
+    admin site, so they can't be changed once built; the annotations and
+    extra selections are stored as sorted tuples of (name, value) pairs.
+
+    """
+    def __init__(self, list_display, select_related, annotations,
+                 extra_select, only_fields):
+        set_attr = super(ChangeListPlan, self).__setattr__
+        set_attr('list_display', tuple(list_display))
+        set_attr('select_related', tuple(select_related))
+        set_attr('annotations', tuple(sorted(annotations.items())))
+        set_attr('extra_select', tuple(sorted(extra_select.items())))
+        set_attr('only_fields', only_fields)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
+_plan_cache = {}
+_plan_lock = Lock()
+
+def clear_changelist_plans():
+    """Forget every cached `ChangeListPlan`."""
+    _plan_cache.clear()
+
+def prepare_columns(columns, objs, executor=None):
+    """
+    Do the fetch phase of rendering `objs` for each of the given columns
+    (see `ChangeListColumn.prepare()`), and return a list of the functions
+    that render their cells. If `executor` is given, the columns are
+    prepared with its `map()` method, which may prepare them concurrently;
+    otherwise they are prepared one after another.
+
+    """
+    def prepare(column):
+        if hasattr(column, 'prepare'):
+            return column.prepare(objs)
+        return lambda: column.render_many(objs)
+    if executor is None:
+        return map(prepare, columns)
+    return list(executor.map(prepare, columns))
+
+
+class RenderedColumn(object):
+    """
+    Stand-in for a changelist column that returns the content rendered for
+    a whole page of objects at once, given as the list `cells` or rendered
+    by a single call to the column's `render_cached()` (or `render_many()`,
+    for columns without a cell cache). Other attributes are taken from the
+    column.
+
+    """
+    def __init__(self, column, objs, cells=None):
+        self.column = column
+        if cells is None:
+            render = getattr(column, 'render_cached', column.render_many)
+            cells = render(objs)
+        self.cells = dict(zip(map(id, objs), cells))
+
+    def __call__(self, obj):
+        try:
+            return self.cells[id(obj)]
+        except KeyError:
+            return self.column(obj)
+
+    def __getattr__(self, name):
+        return getattr(self.column, name)
+
+
+class BrowseChangeList(ChangeList):
+    """
+    `ChangeList` that lets its `AutoBrowseModelAdmin` adjust the changelist
+    `QuerySet` with `apply_changelist_plan()`, and that renders each column
+    for the whole page at once. The fetch phase of every column is done
+    before any column is rendered, using the admin's `column_executor`.
+
+    If the admin enables `keyset_pagination` and the changelist is ordered
+    by a field that `keyset_lookup()` accepts, pages are found by comparing
+    the ordering field and primary key with those of the row before or
+    after them (given as a cursor in the query string) instead of with an
+    offset, and `keyset_page` is True. The first, previous and next pages
+    are then linked to by `keyset_first_url`, `keyset_previous_url` and
+    `keyset_next_url`, which are None if there is no such page. Otherwise,
+    as when sorting by a count annotation, the changelist is paged by
+    offset as usual and `keyset_page` is False.
+
+    Unless the admin's `result_count_mode` is 'exact', the objects are
+    counted with `get_result_counts()` instead of `COUNT(*)`.
+
+    """
+    keyset = None
+    cursor = None
+    keyset_page = False
+    keyset_first_url = keyset_previous_url = keyset_next_url = None
+
+    def get_query_set(self):
+        if self.model_admin.keyset_pagination:
+            for name in (AFTER_VAR, BEFORE_VAR):
+                if name in self.params:
+                    self.cursor = (name, self.params.pop(name))
+            if self.order_field:
+                self.keyset = keyset_lookup(self.model, self.order_field)
+        qs = super(BrowseChangeList, self).get_query_set()
+        if self.keyset is not None:
+            qs = qs.order_by(*self.get_keyset_ordering())
+        return self.model_admin.apply_changelist_plan(qs)
+
+    def get_keyset_ordering(self):
+        """Return the ordering that keyset pagination pages through."""
+        prefix = self.order_type == 'desc' and '-' or ''
+        lookup, attrs = self.keyset
+        if lookup == 'pk':
+            return [prefix + 'pk']
+        return [prefix + lookup, prefix + 'pk']
+
+    def get_results(self, request):
+        if self.model_admin.result_count_mode == EXACT:
+            super(BrowseChangeList, self).get_results(request)
+        else:
+            self.get_approximate_results()
+        if self.keyset is not None and self.multi_page and \
+           not (self.show_all and self.can_show_all):
+            # Keep a QuerySet, which the list_editable formset needs.
+            self.result_list = self.query_set._clone()
+            self.result_list._result_cache = self.get_keyset_results()
+        # Evaluating the page fills its result cache, so the columns and the
+        # list_editable formset (which needs a QuerySet) share its objects.
+        objects = list(self.result_list)
+        columns = [column for column in self.list_display
+                   if self.renders_page(column)]
+        renderers = prepare_columns(columns, objects,
+                                    self.model_admin.column_executor)
+        rendered = {}
+        for column, render in zip(columns, renderers):
+            rendered[id(column)] = RenderedColumn(column, objects,
+                                                  render())
+        self.list_display = [rendered.get(id(column), column)
+                             for column in self.list_display]
+
+    def renders_page(self, column):
+        """Return True if `column` is rendered for the whole page at once."""
+        return hasattr(column, 'render_many') and \
+               column not in self.list_display_links
+
+    def get_result_counts(self):
+        """
+        Return the number of objects in the changelist and in the whole
+        table as `ApproximateCount` instances, according to the admin's
+        `result_count_mode`.
+
+        """
+        cap = self.model_admin.result_count_cap
+        full_result_count = None
+        root_query = self.root_query_set.query
+        if self.model_admin.result_count_mode == ESTIMATED and \
+           not (root_query.where or root_query.having):
+            # The statistics only know the size of the whole table, not of
+            # a queryset() that filters it.
+            full_result_count = estimate_count(self.model,
+                                               self.root_query_set.db)
+            if full_result_count is not None and full_result_count < cap:
+                # Small enough to count.
+                full_result_count = None
+        if full_result_count is None:
+            full_result_count = capped_count(self.root_query_set, cap)
+        if self.query_set.query.where or self.query_set.query.having:
+            result_count = capped_count(self.query_set, cap)
+        else:
+            result_count = full_result_count
+        return result_count, full_result_count
+
+    def get_approximate_results(self):
+        """
+        Like `ChangeList.get_results()`, but counting the objects with
+        `get_result_counts()`. The paginator's `accuracy` is that of the
+        count, and "Show all" is only offered if the count is exact.
+
+        """
+        result_count, full_result_count = self.get_result_counts()
+        paginator = CountPaginator(self.query_set, self.list_per_page,
+                                   result_count)
+        can_show_all = result_count.accuracy == EXACT and \
+                       result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+        if (self.show_all and can_show_all) or not multi_page:
+            result_list = self.query_set._clone()
+        else:
+            try:
+                result_list = paginator.page(self.page_num + 1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+    def get_keyset_results(self):
+        """
+        Return the list of objects on the page after or before the cursor
+        given in the query string (or the first page), and set the URLs of
+        the first, previous and next pages.
+
+        """
+        lookup, attrs = self.keyset
+        forward = self.cursor is None or self.cursor[0] == AFTER_VAR
+        qs = self.query_set
+        if self.cursor is not None:
+            # Rows after the cursor in the direction of travel.
+            op = forward != (self.order_type == 'desc') and 'gt' or 'lt'
+            if lookup == 'pk':
+                pk, = decode_cursor(self.cursor[1], 1)
+                condition = Q(**{'pk__' + op: pk})
+            else:
+                value, pk = decode_cursor(self.cursor[1], 2)
+                condition = Q(**{'%s__%s' % (lookup, op): value}) | \
+                            Q(**{lookup: value, 'pk__' + op: pk})
+        if not forward:
+            qs = qs.reverse()
+        try:
+            if self.cursor is not None:
+                qs = qs.filter(condition)
+            results = list(qs[:self.list_per_page + 1])
+        except (ValueError, TypeError, ValidationError):
+            # The cursor's values don't suit the ordering field.
+            raise IncorrectLookupParameters
+        more = len(results) > self.list_per_page
+        results = results[:self.list_per_page]
+        if not forward:
+            results.reverse()
+        has_previous = forward and self.cursor is not None or \
+                       not forward and more
+        has_next = not forward or more
+        self.keyset_page = True
+        if has_previous and results:
+            self.keyset_first_url = self.get_query_string()
+            self.keyset_previous_url = self.get_query_string(
+                {BEFORE_VAR: self.get_cursor(results[0])})
+        if has_next and results:
+            self.keyset_next_url = self.get_query_string(
+                {AFTER_VAR: self.get_cursor(results[-1])})
+        return results
+
+    def get_cursor(self, obj):
+        """Return the keyset pagination cursor at `obj`."""
+        lookup, attrs = self.keyset
+        if lookup == 'pk':
+            return encode_cursor([obj.pk])
+        value = obj
+        for attr in attrs:
+            value = getattr(value, attr)
+        return encode_cursor([value, obj.pk])
 
 
 class AutoBrowseModelAdmin(ModelAdmin):
@@ -12,13 +431,113 @@ class AutoBrowseModelAdmin(ModelAdmin):
 
     - Linking to the change form for `ForeignKey` fields.
     - Linking to the URL for `URLField` fields.
+    - Working all of this out once per admin class, model, `list_display`
+      and admin site, when a changelist is first shown, and sharing the
+      result (see `ChangeListPlan` and `load_changelist_plan()`) rather
+      than modifying `list_display` in place.
+    - Following every relation needed by `link_to_change` columns in
+      `list_display` with `select_related()`, so the number of queries
+      doesn't grow with the number of rows on the page.
+    - Rendering each adminbrowse column for the whole page at once, so that
+      the related objects for `related_list` and `link_to_changelist`
+      columns are fetched with one query per column.
+    - Counting the related objects for `link_to_changelist` columns in
+      `count` mode, and for `sortable` columns, with a single grouped query.
+    - Selecting the truncated text for `truncated_field` columns in
+      `in_database` mode with SQL, instead of loading the whole field.
+    - Loading only the fields that `list_display` needs, if every entry
+      says what it needs (see `ChangeListColumn.required_fields`) and no
+      column needs a `Count()` annotation, which Django 1.2 can't combine
+      with `only()`.
+    - Taking the cells of columns that use `cache_cells()` from the cache,
+      fetching a whole page's cells at once.
+
+    Set `column_executor` to an object with a `map()` method, such as
+    `adminbrowse.executors.ThreadPool`, to do the fetch phase of every
+    column on a changelist page through it, for example concurrently (see
+    `prepare_columns()`).
+
+    Set `keyset_pagination = True` to page through large tables by the
+    ordering field and primary key rather than by offset, with links to the
+    first, previous and next pages (see `BrowseChangeList`). Unless the
+    admin has its own `change_list_template`, the changelist then uses
+    'adminbrowse/change_list.html', which extends 'admin/change_list.html'.
+    Orderings that `keyset_lookup()` can't use still page by offset, with
+    numbered pages: sorting by a sortable count column (its `Count()`
+    annotation isn't a model field), or by a nullable or related field.
+    Sort by a `counter_field` instead to keep keyset pages.
+
+    Set `result_count_mode` to 'capped' to count at most `result_count_cap`
+    objects, or to 'estimated' to take the size of the whole table from the
+    database's statistics (see `adminbrowse.paginators`).
 
     This will also include the adminbrowse media definition.
-    
+
     """
+    column_executor = None
+    keyset_pagination = False
+    result_count_mode = EXACT
+    result_count_cap = 10000
+
+    _changelist_plan = None
+
     def __init__(self, model, admin_site):
         super(AutoBrowseModelAdmin, self).__init__(model, admin_site)
-        for i, name in enumerate(self.list_display):
+        if self.keyset_pagination and self.change_list_template is None:
+            self.change_list_template = 'adminbrowse/change_list.html'
+
+    def load_changelist_plan(self):
+        """
+        Return the admin's `ChangeListPlan`, replacing `list_display` with
+        the plan's columns the first time. This happens when a changelist
+        is first shown or exported, not when the admin is registered, so
+        that starting up doesn't resolve every column.
+
+        """
+        plan = self._changelist_plan
+        if plan is None:
+            plan = self.get_changelist_plan()
+            self.list_display = plan.list_display
+            self._changelist_plan = plan
+        return plan
+
+    changelist_plan = property(load_changelist_plan)
+    select_related = property(lambda self:
+                              self.load_changelist_plan().select_related)
+    annotations = property(lambda self:
+                           dict(self.load_changelist_plan().annotations))
+    extra_select = property(lambda self:
+                            dict(self.load_changelist_plan().extra_select))
+    only_fields = property(lambda self:
+                           self.load_changelist_plan().only_fields)
+
+    def get_changelist_plan(self):
+        """
+        Return the `ChangeListPlan` for this admin's `list_display`, building
+        it the first time it is needed for this admin class, model,
+        `list_display` and admin site.
+
+        """
+        key = (self.__class__, self.model, tuple(self.list_display),
+               self.admin_site)
+        try:
+            return _plan_cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # An unhashable list_display entry; don't cache.
+            return self.build_changelist_plan()
+        _plan_lock.acquire()
+        try:
+            if key not in _plan_cache:
+                _plan_cache[key] = self.build_changelist_plan()
+            return _plan_cache[key]
+        finally:
+            _plan_lock.release()
+
+    def build_changelist_plan(self):
+        list_display = []
+        for name in self.list_display:
             if isinstance(name, basestring):
                 try:
                     field, model_, direct, m2m = \
@@ -28,7 +547,20 @@ class AutoBrowseModelAdmin(ModelAdmin):
                 else:
                     column = self._get_changelist_column(field)
                     if column is not None:
-                        self.list_display[i] = column
+                        name = column
+            list_display.append(name)
+        annotations = annotation_plan(list_display)
+        if annotations:
+            # Django 1.2 reads the aggregates (and the fields after them)
+            # from the wrong columns when only() and annotate() are combined.
+            only_fields = None
+        else:
+            only_fields = only_plan(self.model, list_display)
+        return ChangeListPlan(list_display,
+                              select_related_plan(list_display),
+                              annotations,
+                              extra_select_plan(list_display),
+                              only_fields)
 
     def _get_changelist_column(self, field):
         if isinstance(field, ForeignKey):
@@ -36,6 +568,31 @@ class AutoBrowseModelAdmin(ModelAdmin):
         elif isinstance(field, URLField):
             return link_to_url(self.model, field.name)
 
+    def get_changelist(self, request, **kwargs):
+        return BrowseChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        self.load_changelist_plan()
+        return super(AutoBrowseModelAdmin, self).changelist_view(
+            request, extra_context)
+
+    def apply_changelist_plan(self, qs):
+        """
+        Return `qs` with the adjustments needed to render the adminbrowse
+        columns in `list_display` efficiently.
+
+        """
+        plan = self.load_changelist_plan()
+        if plan.select_related:
+            qs = qs.select_related(*plan.select_related)
+        if plan.annotations:
+            qs = qs.annotate(**dict(plan.annotations))
+        if plan.extra_select:
+            qs = qs.extra(select=dict(plan.extra_select))
+        if plan.only_fields is not None:
+            qs = qs.only(*plan.only_fields)
+        return qs
+
     class Media:
         css = {'all': (settings.ADMINBROWSE_MEDIA_URL +
                        'css/adminbrowse.css',)}
@@ -1,7 +1,98 @@
+import os
+from inspect import getargspec
+from threading import local, RLock
+
 from django.contrib import admin
-from django.template.loader import render_to_string
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import (get_template, select_template,
+                                    find_template_loader)
 from django.db.models import FieldDoesNotExist
+from django.core.cache import cache
+from django.core.urlresolvers import get_urlconf, get_script_prefix
 from django.utils.text import force_unicode
+from django.utils.html import strip_tags
+from django.utils.translation import get_language
+from django.utils.hashcompat import md5_constructor
+from django.conf import settings
+
+# Part of the key for every string cached by `ChangeListColumn.get_string()`;
+# incremented by `clear_string_caches()`.
+_string_cache_generation = 0
+
+def clear_string_caches():
+    """
+    Invalidate the strings cached by every column's `get_string()`. Call this
+    after reloading translation catalogs.
+
+    """
+    global _string_cache_generation
+    _string_cache_generation += 1
+
+# The entities added by `django.utils.html.escape()`; '&amp;' comes last so
+# that it isn't replaced before the entities it is part of.
+_escape_entities = [('&lt;', '<'), ('&gt;', '>'), ('&quot;', '"'),
+                    ('&#39;', "'"), ('&amp;', '&')]
+
+def strip_entities(text):
+    """Replace the entities added by HTML escaping with their characters."""
+    for entity, char in _escape_entities:
+        text = text.replace(entity, char)
+    return text
+
+# Maps template names to whether the loaders find adminbrowse's own copy.
+_builtin_template_cache = {}
+
+def template_source_path(template_name):
+    """
+    Return the path of the file that the configured template loaders load
+    `template_name` from, or None if none of them finds it.
+
+    """
+    loaders = [find_template_loader(loader)
+               for loader in settings.TEMPLATE_LOADERS]
+    while loaders:
+        loader = loaders.pop(0)
+        if loader is None:
+            continue
+        if hasattr(loader, 'loaders'):
+            # The cached loader delegates to other loaders.
+            loaders[:0] = loader.loaders
+            continue
+        load = getattr(loader, 'load_template_source', loader)
+        try:
+            source, path = load(template_name)
+        except (TemplateDoesNotExist, NotImplementedError):
+            continue
+        return path
+    return None
+
+def uses_builtin_template(template_name):
+    """
+    Return True if `template_name` is loaded from adminbrowse's own
+    templates, that is, the project doesn't override it. The answer is
+    cached; call `clear_builtin_template_cache()` if the templates or
+    template settings change.
+
+    """
+    try:
+        return _builtin_template_cache[template_name]
+    except KeyError:
+        pass
+    builtin = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'templates', *template_name.split('/'))
+    path = template_source_path(template_name)
+    result = path is not None and \
+             os.path.normcase(os.path.abspath(path)) == \
+             os.path.normcase(builtin)
+    _builtin_template_cache[template_name] = result
+    return result
+
+def clear_builtin_template_cache():
+    """Forget the answers cached by `uses_builtin_template()`."""
+    _builtin_template_cache.clear()
+
+# Held while any column resolves its model metadata.
+_resolve_lock = RLock()
 
 
 class ChangeListColumn(object):
@@ -15,16 +106,189 @@ class ChangeListColumn(object):
     If `__call__()` returns HTML content intended to be rendered, the
     class or instance should set `allow_tags` to True.
 
+    Strings that are the same for every row, such as translated link titles,
+    can be cached with `get_string()`.
+
+    To render a whole page of rows at once, call `render_many()` with the
+    page's objects. By default it just calls `__call__()` for each object;
+    subclasses override it to share work between rows, typically by
+    fetching what the page needs with `prefetch()` first. `prepare()`
+    splits this into a fetch phase and a rendering phase, so that the
+    fetches for several columns can run at the same time.
+
+    If the column only reads certain fields of the objects it renders, set
+    `required_fields` to a list of their names; `AutoBrowseModelAdmin`
+    uses it to load only the fields needed by `list_display`. The default of
+    None means the column's needs are unknown.
+
+    The time spent and the queries executed by each column's `__call__()`,
+    `render_many()`, `render_text_many()` and `prefetch()` methods can be
+    recorded; see `adminbrowse.instrumentation`.
+
+    Columns whose content only depends on the row being rendered can keep
+    their rendered cells in Django's cache; see `cache_cells()`.
+
+    For exports, `render_text()` and `render_text_many()` return the
+    column's content as plain text, without any HTML.
+
     """
     allow_tags = False
+    required_fields = None
+    cell_cache_version = None
+    cell_cache_timeout = None
+    cell_cache_name = None
 
     def __init__(self, short_description, admin_order_field=None):
         self.short_description = short_description
         self.admin_order_field = admin_order_field
+        self._strings = {}
 
     def __call__(self, obj):
         raise NotImplementedError
 
+    def render_many(self, objs):
+        """Return a list of the column's content for each object in `objs`."""
+        return [self(obj) for obj in objs]
+
+    def render_text(self, obj):
+        """
+        Return the column's content for `obj` as plain text. By default,
+        this is the rendered content with any HTML tags and entities
+        removed.
+
+        """
+        text = force_unicode(self(obj))
+        if self.allow_tags:
+            text = strip_entities(strip_tags(text))
+        return text
+
+    def render_text_many(self, objs):
+        """
+        Return a list of the column's plain text content for each object in
+        `objs`, prefetching what they need first.
+
+        """
+        self.prefetch(objs)
+        return [self.render_text(obj) for obj in objs]
+
+    def prefetch(self, objects):
+        """
+        Fetch what rendering `objects` needs with as few queries as possible,
+        and cache it on the objects. Objects that already have it cached are
+        skipped. Does nothing by default.
+
+        """
+
+    def prepare(self, objs):
+        """
+        Do the fetch phase of rendering `objs`: prefetch what they need, and
+        read their cells from the cell cache if `cache_cells()` was used.
+        Return a function that does the rendering phase, returning a list
+        like `render_many()`.
+
+        The fetch phase of a column doesn't depend on other columns, so
+        several columns may be prepared concurrently; the returned functions
+        should be called one after another.
+
+        """
+        if self.cell_cache_version is None:
+            self.prefetch(objs)
+            return lambda: self.render_many(objs)
+        keys = self.get_cell_cache_keys(objs)
+        cells = cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cells]
+        self.prefetch([objs[i] for i in missing])
+
+        def render():
+            if missing:
+                rendered = self.render_many([objs[i] for i in missing])
+                rendered = dict([(keys[i], cell) for i, cell in
+                                 zip(missing, rendered)])
+                cache.set_many(rendered, self.cell_cache_timeout)
+                cells.update(rendered)
+            return [cells[key] for key in keys]
+        return render
+
+    def cache_cells(self, version_field, timeout=None, name=None):
+        """
+        Keep the cells rendered by `render_cached()` in Django's cache, and
+        return the column, so that it can be used directly in
+        `list_display`.
+
+        `version_field` names a field of the model whose value changes
+        whenever anything the cell shows does, such as a `DateTimeField`
+        with `auto_now=True`. Cells are cached for each object, version,
+        language and URLconf, under the column's `name`, which defaults to
+        its class and field name; give columns of the same class for the
+        same field different names. `timeout` is passed to the cache.
+
+        """
+        if name is None:
+            name = '%s.%s' % (self.__class__.__module__,
+                              self.__class__.__name__)
+            if getattr(self, 'field_name', None):
+                name += '.' + self.field_name
+        self.cell_cache_version = version_field
+        self.cell_cache_timeout = timeout
+        self.cell_cache_name = name
+        return self
+
+    def get_cell_cache_keys(self, objs):
+        """Return a list of the cell cache keys for the objects in `objs`."""
+        # Everything but the object and its version is the same for the
+        # whole page.
+        page = [self.cell_cache_name, get_language(),
+                get_urlconf() or settings.ROOT_URLCONF, get_script_prefix()]
+        page = u'|'.join(map(force_unicode, page))
+        keys = []
+        for obj in objs:
+            opts = obj._meta
+            row = u'|'.join(map(force_unicode, [
+                page, opts.app_label, opts.module_name, obj.pk,
+                getattr(obj, self.cell_cache_version)]))
+            digest = md5_constructor(row.encode('utf-8')).hexdigest()
+            keys.append('adminbrowse.cell.%s' % digest)
+        return keys
+
+    def render_cached(self, objs):
+        """
+        Return a list of the column's content for each object in `objs`,
+        like `render_many()`, but take the cells from the cache if
+        `cache_cells()` was used. All cells are fetched with one call to
+        the cache's `get_many()`, and only the missing ones are rendered.
+
+        """
+        return self.prepare(objs)()
+
+    def get_string(self, key, func):
+        """
+        Return the string returned by calling `func()`, cached under `key`
+        for the active language. `func` should translate and interpolate
+        a string that doesn't depend on the row being rendered.
+
+        """
+        cache_key = (_string_cache_generation, get_language(), key)
+        try:
+            return self._strings[cache_key]
+        except KeyError:
+            string = self._strings[cache_key] = func()
+            return string
+
+def accepts_context(get_context):
+    """
+    Return True if the `get_context` callable takes a `context` argument
+    after the object, False for the older `get_context(obj)` signature.
+
+    """
+    function = getattr(get_context, 'im_func', get_context)
+    try:
+        args, varargs, varkw, defaults = getargspec(function)
+    except TypeError:
+        return False
+    if getattr(get_context, 'im_self', None) is not None:
+        args = args[1:]
+    return bool(varargs) or len(args) >= 2
+
 class ChangeListTemplateColumn(ChangeListColumn):
     """Class for rendering changelist column content from a template.
 
@@ -37,56 +301,188 @@ class ChangeListTemplateColumn(ChangeListColumn):
     changelist row is being rendered). Additional context variables may be
     added by setting `extra_context`.
 
+    The template is loaded and compiled once, on first use, and every row is
+    rendered with the same `Context` (one per thread), pushing and popping
+    the row's variables. `render_many()` also fills the same dictionary
+    with each row's variables: `get_context()` takes it as its optional
+    `context` argument, and should set every variable it uses for each row.
+    Subclasses that override `get_context(obj)` without the argument still
+    work, with a new dictionary for each row.
+    Call `reset_template()` to load the template again, for example after
+    editing it during development. Override `render()` to produce the HTML
+    some other way.
+
     This class is aliased as `adminbrowse.template_column` for better
     readability in `ModelAdmin` code.
 
     """
     allow_tags = True
     extra_context = {}
+    template = None
 
     def __init__(self, short_description, template_name=None,
                  extra_context=None, admin_order_field=None):
         ChangeListColumn.__init__(self, short_description, admin_order_field)
         self.template_name = template_name or self.template_name
         self.extra_context = extra_context or self.extra_context
+        self._local = local()
 
     def __call__(self, obj):
         context = self.get_context(obj)
-        return render_to_string(self.template_name, context)
+        return self.render(context)
+
+    def render_many(self, objs):
+        get_context = self.get_context
+        if not accepts_context(get_context):
+            return [self.render(get_context(obj)) for obj in objs]
+        context = {}
+        return [self.render(get_context(obj, context)) for obj in objs]
+
+    def render(self, context):
+        """Render the column's template with the `context` dictionary."""
+        template = self.get_template()
+        context_instance = getattr(self._local, 'context', None)
+        if context_instance is None:
+            context_instance = self._local.context = Context()
+        context_instance.update(context)
+        try:
+            return template.render(context_instance)
+        finally:
+            context_instance.pop()
+
+    def get_template(self):
+        """Return the compiled template, loading it on first use."""
+        if self.template is None:
+            if isinstance(self.template_name, (list, tuple)):
+                self.template = select_template(self.template_name)
+            else:
+                self.template = get_template(self.template_name)
+        return self.template
+
+    def reset_template(self):
+        """Forget the compiled template so that it is loaded again."""
+        self.template = None
 
-    def get_context(self, obj):
-        context = {'column': self, 'object': obj}
-        context.update(self.extra_context)
+    def get_context(self, obj, context=None):
+        """
+        Return the template context for `obj`, filling and returning
+        `context` instead of a new dictionary if it is given.
+
+        """
+        if context is None:
+            context = {}
+        context['column'] = self
+        context['object'] = obj
+        if self.extra_context:
+            context.update(self.extra_context)
         return context
 
+class LazyMetadata(object):
+    """
+    Descriptor for a column attribute that is worked out from the model's
+    metadata by the column's `resolve()` method the first time it is read.
+    Once resolved, the value is stored on the instance, which hides the
+    descriptor, so later reads cost nothing extra.
+
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        instance.resolve()
+        try:
+            return instance.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
 class ChangeListModelFieldColumn(ChangeListColumn):
+    """
+    Base class for changelist columns that render a field of the model.
+
+    The constructor only records `model` and the field `name`. The field and
+    everything derived from it (`field`, `model`, `opts`, `direct`, `m2m`,
+    and the defaults for `short_description`, `admin_order_field` and
+    `required_fields`) are looked up by `resolve()` the first time one of
+    them is used, so that defining columns in admin modules doesn't load
+    model metadata. Subclasses add their own metadata by extending
+    `_resolve()` and declaring the attributes with `LazyMetadata`.
+
+    """
+    field = LazyMetadata('field')
+    model = LazyMetadata('model')
+    opts = LazyMetadata('opts')
+    direct = LazyMetadata('direct')
+    m2m = LazyMetadata('m2m')
+    short_description = LazyMetadata('short_description')
+    admin_order_field = LazyMetadata('admin_order_field')
+    required_fields = LazyMetadata('required_fields')
+    _resolved = False
+    _resolving = False
+
     def __init__(self, model, name, short_description=None, default=""):
         ChangeListColumn.__init__(self, short_description, None)
+        # Defaults that depend on the field are set by _resolve().
+        if short_description is None:
+            del self.short_description
+        del self.admin_order_field
+        self.model_class = model
         self.field_name = name
+        self.default = default
+
+    def resolve(self):
+        """
+        Look up the column's metadata from the model, if it hasn't been
+        already. This is safe to call from several threads at once.
+
+        """
+        if self._resolved:
+            return
+        _resolve_lock.acquire()
         try:
-            field, model_, self.direct, self.m2m = \
-                model._meta.get_field_by_name(name)
+            if not (self._resolved or self._resolving):
+                # Attributes are only ever set to their final values, so
+                # other threads may use the ones already set meanwhile.
+                self._resolving = True
+                try:
+                    self._resolve()
+                    self._resolved = True
+                finally:
+                    self._resolving = False
+        finally:
+            _resolve_lock.release()
+
+    def _resolve(self):
+        model, name = self.model_class, self.field_name
+        try:
+            field, model_, direct, m2m = model._meta.get_field_by_name(name)
         except FieldDoesNotExist:
             descriptor = getattr(model, name)
             field = descriptor.related
-            self.direct = False
-            self.m2m = True
-        if self.direct:
+            direct = False
+            m2m = True
+        self.direct, self.m2m = direct, m2m
+        if direct:
             self.field = field
             self.model = field.model
             self.opts = self.model._meta
-            if not self.m2m:
-                self.admin_order_field = name
         else:
             self.field = field.field
             self.model = field.parent_model
             self.opts = field.parent_model._meta
-        if self.short_description is None:
-            if self.direct:
+        if 'admin_order_field' not in self.__dict__:
+            self.admin_order_field = direct and not m2m and name or None
+        if 'short_description' not in self.__dict__:
+            if direct:
                 self.short_description = force_unicode(field.verbose_name)
             else:
                 self.short_description = force_unicode(name.replace('_', ' '))
-        self.default = default
+        if 'required_fields' not in self.__dict__:
+            if direct and not m2m:
+                self.required_fields = [name]
+            else:
+                self.required_fields = []
 
     def __call__(self, obj):
         value = getattr(obj, self.field_name)
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
+from django.db import connection
 from django.utils.text import force_unicode
 from django.utils.translation import ugettext as _
 
-from adminbrowse.base import ChangeListModelFieldColumn
+from adminbrowse.base import ChangeListModelFieldColumn, LazyMetadata
 
 
 class URLColumn(ChangeListModelFieldColumn):
@@ -37,16 +38,29 @@ class URLColumn(ChangeListModelFieldColumn):
         self.classes = list(classes)
 
     def __call__(self, obj):
-        value = getattr(obj, self.field_name)
-        if value:
-            title = self.get_title(obj, value)
-            classes = " ".join(self.classes)
-            html = '<a href="%s" target="%s" class="%s" title="%s">%s</a>'
-            return html % (value, self.target, classes, title, value)
-        else:
-            return self.default
+        return self.render_many([obj])[0]
+
+    def render_many(self, objs):
+        classes = " ".join(self.classes)
+        html = '<a href="%s" target="%s" class="%s" title="%s">%s</a>'
+        results = []
+        for obj in objs:
+            value = getattr(obj, self.field_name)
+            if value:
+                title = self.get_title(obj, value)
+                results.append(html % (value, self.target, classes, title,
+                                       value))
+            else:
+                results.append(self.default)
+        return results
+
+    def render_text(self, obj):
+        return force_unicode(getattr(obj, self.field_name) or self.default)
 
     def get_title(self, obj, value):
+        return self.get_string(('title', self.target), self._get_title)
+
+    def _get_title(self):
         if self.target == '_blank':
             return _("Open URL in a new window")
         else:
@@ -69,26 +83,58 @@ class TruncatedFieldColumn(ChangeListModelFieldColumn):
     The `tail` argument specifies the final truncation string, and defaults to
     an ellipsis.
 
+    If `in_database` is True, the column asks for the first `max_length` + 1
+    characters of the field to be selected with the SQL `SUBSTR()` function
+    (see `extra_select`), and renders from that instead of the field, so the
+    full value never needs to be loaded. `AutoBrowseModelAdmin` selects the
+    substring and defers the field; the field is used if the substring was
+    not selected.
+
     This class is aliased as `adminbrowse.truncated_field` for better
     readability in `ModelAdmin` code.
 
     """
+    extra_select = LazyMetadata('extra_select')
+
     def __init__(self, model, name, max_length, short_description=None,
-                 default="", tail=u"…"):
+                 default="", tail=u"…", in_database=False):
         ChangeListModelFieldColumn.__init__(self, model, name,
                                             short_description, default)
         self.max_length = max_length
         self.tail = tail
+        self.in_database = in_database
+        if in_database:
+            self.substr_name = '_adminbrowse_%s_substr' % name
+            self.required_fields = []
+
+    def _resolve(self):
+        ChangeListModelFieldColumn._resolve(self)
+        if self.in_database:
+            qn = connection.ops.quote_name
+            self.extra_select = {self.substr_name: 'SUBSTR(%s.%s, 1, %d)' % (
+                qn(self.opts.db_table), qn(self.field.column),
+                self.max_length + 1)}
 
     def __call__(self, obj):
-        value = getattr(obj, self.field_name)
-        if value:
-            text = force_unicode(value)
-            if len(text) > self.max_length:
-                text = text[:self.max_length] + self.tail
-            return text
-        else:
-            return self.default
+        return self.render_many([obj])[0]
+
+    def render_many(self, objs):
+        field_name, max_length = self.field_name, self.max_length
+        substr_name = self.in_database and self.substr_name
+        results = []
+        for obj in objs:
+            if substr_name and hasattr(obj, substr_name):
+                value = getattr(obj, substr_name)
+            else:
+                value = getattr(obj, field_name)
+            if value:
+                text = force_unicode(value)
+                if len(text) > max_length:
+                    text = text[:max_length] + self.tail
+                results.append(text)
+            else:
+                results.append(self.default)
+        return results
 
 link_to_url = URLColumn
 truncated_field = TruncatedFieldColumn
@@ -0,0 +1,433 @@
+"""
+Denormalized counts of related objects, kept up to date with signals.
+
+Counting the related objects for every row on every page view, and sorting
+a changelist by those counts, costs a `GROUP BY` over all of the related
+rows. Instead, give the model an integer field for the count, keep it up to
+date with `track_related_count()`, and pass its name as the `counter_field`
+of a `link_to_changelist` or `related_list` column. For example:
+
+    class Person(models.Model):
+        name = models.CharField(max_length=75)
+        book_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Book(models.Model):
+        author = models.ForeignKey(Person, related_name='bibliography')
+
+    track_related_count(Person, 'bibliography', 'book_count')
+
+If the model can't have a counter field (it belongs to another app, say),
+keep the counts in adminbrowse's own `RelatedCount` table instead with
+`store_related_count()`, and pass the `RelatedCountStore` it returns as the
+column's `count_store`:
+
+    bibliography_counts = store_related_count(Person, 'bibliography')
+
+Counts are adjusted as related objects are saved, deleted, added and
+removed, including through a many-to-many field's custom `through` model.
+Changes that don't send signals, such as `QuerySet.update()` or raw SQL,
+aren't seen; run the `rebuild_related_counts` management command
+periodically to recount everything.
+
+"""
+from threading import Lock
+
+from django.db import connections, router, transaction
+from django.db.models import signals, F
+from django.utils.encoding import force_unicode
+
+from adminbrowse.related import RelatedObjectsColumn
+from adminbrowse.models import RelatedCount
+
+# Every tracker created by track_related_count() or store_related_count(),
+# for the rebuild_related_counts command.
+trackers = []
+# The trackers whose signal handlers connect_pending() has yet to connect.
+pending = []
+_pending_lock = Lock()
+
+
+class RelatedCountTracker(object):
+    """
+    Base class for keeping count of the objects related to each instance of
+    `model` by the many-to-many or one-to-many field `name`. Subclasses
+    decide where the counts are kept by implementing `save_counts()` and
+    `adjust()`.
+
+    """
+    def __init__(self, model, name):
+        self.relation = RelatedObjectsColumn(model, name)
+        # Where the handlers keep what they find out before a change on the
+        # instance being changed, separately for each tracker.
+        self.stash_name = '_adminbrowse_tracker_%d' % id(self)
+
+    def get_handlers(self):
+        """
+        Return a list of (signal, handler, sender) tuples for the signal
+        handlers that keep the counts up to date.
+
+        """
+        relation = self.relation
+        if relation.m2m:
+            through = relation.field.rel.through
+            if not through._meta.auto_created:
+                # Relations with a custom intermediary model are changed by
+                # saving and deleting its objects, and never send
+                # m2m_changed. Deleting a related object deletes them too.
+                counted, other = self.get_through_fields()
+                self.key_attname = through._meta.get_field(counted).attname
+                sender = through
+            else:
+                # Deleting a related object deletes its rows in the
+                # intermediary table without sending m2m_changed.
+                return [
+                    (signals.m2m_changed, self.m2m_changed, through),
+                    (signals.pre_delete, self.pre_delete_related,
+                     relation.to_model),
+                    (signals.post_delete, self.post_delete_related,
+                     relation.to_model)]
+        else:
+            self.key_attname = relation.field.attname
+            sender = relation.to_model
+        return [(signals.pre_save, self.pre_save, sender),
+                (signals.post_save, self.post_save, sender),
+                (signals.post_delete, self.post_delete, sender)]
+
+    def connect(self):
+        """Connect the signal handlers that keep the counts up to date."""
+        for signal, handler, sender in self.get_handlers():
+            signal.connect(handler, weak=False, sender=sender)
+
+    def disconnect(self):
+        """Disconnect the signal handlers connected by `connect()`."""
+        for signal, handler, sender in self.get_handlers():
+            signal.disconnect(handler, sender=sender)
+
+    def save_counts(self, counts):
+        """
+        Store `counts`, a dictionary mapping values of the relation's
+        `rel_name` field to the number of related objects.
+
+        """
+        raise NotImplementedError
+
+    def adjust(self, deltas):
+        """
+        Add to the stored counts, given a dictionary mapping values of the
+        relation's `rel_name` field to the change in their count.
+
+        """
+        raise NotImplementedError
+
+    def update(self, keys):
+        """
+        Recount the related objects for the objects whose `rel_name` field
+        has one of the values in `keys`, and store the counts.
+
+        """
+        # The keys given to m2m_changed may be strings (when a fixture is
+        # loaded, say), which wouldn't match the counted values.
+        field = self.relation.model._meta.get_field(self.relation.rel_name)
+        keys = set([field.to_python(key) for key in keys if key is not None])
+        if keys:
+            self.save_counts(self.relation.count_related(keys))
+
+    def update_chunk(self, keys):
+        """
+        Recount the related objects for the objects whose `rel_name` field
+        has one of the values in `keys`, for `update_all()`. Subclasses may
+        store the counts with fewer queries than `update()`.
+
+        """
+        self.update(keys)
+
+    def update_all(self, chunk_size=500):
+        """
+        Recount the related objects for every object of the model, passing
+        the `rel_name` values of `chunk_size` objects at a time, in order,
+        to `update_chunk()`.
+
+        """
+        rel_name = self.relation.rel_name
+        keys = self.relation.model._default_manager.order_by(
+            rel_name).values_list(rel_name, flat=True)
+        if self.relation.model._meta.get_field(rel_name).null:
+            keys = keys.exclude(**{'%s__isnull' % rel_name: True})
+        chunk = list(keys[:chunk_size])
+        while chunk:
+            self.update_chunk(chunk)
+            if len(chunk) < chunk_size:
+                break
+            chunk = list(keys.filter(**{
+                '%s__gt' % rel_name: chunk[-1]})[:chunk_size])
+
+    def rebuild(self):
+        """Recount everything, discarding the stored counts."""
+        self.update_all()
+
+    def get_through_fields(self):
+        """
+        Return the names of the fields of the relation's intermediary model
+        that refer to the counted objects and to the related objects.
+
+        """
+        field = self.relation.field
+        if self.relation.direct:
+            return field.m2m_field_name(), field.m2m_reverse_field_name()
+        return field.m2m_reverse_field_name(), field.m2m_field_name()
+
+    def get_counted_keys(self, related):
+        """
+        Return a list of the `rel_name` values of the counted objects that
+        the object `related` is related to by the many-to-many field.
+
+        """
+        counted, other = self.get_through_fields()
+        through = self.relation.field.rel.through
+        rows = through._default_manager.filter(**{other: related.pk})
+        return list(rows.values_list(counted, flat=True))
+
+    # The handlers below follow the objects that refer to the counted
+    # objects by their `key_attname` field: the related objects of a
+    # one-to-many relation, or those of a custom intermediary model.
+
+    def pre_save(self, sender, instance, **kwargs):
+        # The object may be moving away from another counted object, whose
+        # count must go down.
+        attname = self.key_attname
+        old = None
+        if instance.pk is not None:
+            values = sender._default_manager.filter(
+                pk=instance.pk).values_list(attname, flat=True)
+            if values:
+                old = values[0]
+        instance.__dict__[self.stash_name] = old
+
+    def post_save(self, sender, instance, created=False, **kwargs):
+        attname = self.key_attname
+        old = instance.__dict__.pop(self.stash_name, None)
+        new = getattr(instance, attname)
+        if created:
+            self.adjust({new: 1})
+        elif old != new:
+            self.adjust({old: -1, new: 1})
+
+    def post_delete(self, sender, instance, **kwargs):
+        self.adjust({getattr(instance, self.key_attname): -1})
+
+    def pre_delete_related(self, sender, instance, **kwargs):
+        instance.__dict__[self.stash_name] = self.get_counted_keys(instance)
+
+    def post_delete_related(self, sender, instance, **kwargs):
+        self.update(instance.__dict__.pop(self.stash_name, ()))
+
+    def m2m_changed(self, sender, instance, action, reverse, pk_set=None,
+                    **kwargs):
+        relation = self.relation
+        # The objects being counted are on the side of the relation that
+        # declares the field if the column's field is direct. The objects
+        # given to remove() may not have been related, so recount then.
+        if reverse != relation.direct:
+            key = getattr(instance, relation.rel_name)
+            if action == 'post_add':
+                self.adjust({key: len(pk_set or ())})
+            elif action in ('post_remove', 'post_clear'):
+                self.update([key])
+        elif action == 'post_add':
+            self.adjust(dict([(key, 1) for key in pk_set or ()]))
+        elif action == 'post_remove':
+            self.update(pk_set or ())
+        elif action == 'pre_clear':
+            # Find out which objects lose a related object before they do.
+            instance.__dict__[self.stash_name] = \
+                self.get_counted_keys(instance)
+        elif action == 'post_clear':
+            self.update(instance.__dict__.pop(self.stash_name, ()))
+
+class CounterFieldTracker(RelatedCountTracker):
+    """
+    Keeps the integer field `counter_field` of `model` equal to the number
+    of objects related by the field `name`.
+
+    """
+    def __init__(self, model, name, counter_field):
+        RelatedCountTracker.__init__(self, model, name)
+        self.counter_field = counter_field
+
+    def save_counts(self, counts):
+        manager = self.relation.model._default_manager
+        rel_name = self.relation.rel_name
+        for key, count in counts.items():
+            manager.filter(**{rel_name: key}).update(
+                **{self.counter_field: count})
+
+    def update_chunk(self, keys):
+        # Count and store with one UPDATE, whose subquery counts the rows
+        # referring to each updated row.
+        relation = self.relation
+        model, group_by = relation.get_count_source()
+        opts, counted_opts = relation.model._meta, model._meta
+        if counted_opts.db_table == opts.db_table:
+            # The subquery couldn't refer to the updated table.
+            return self.update(keys)
+        db = router.db_for_write(relation.model)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        rel_field = opts.get_field(relation.rel_name)
+        outer = '%s.%s' % (qn(opts.db_table), qn(rel_field.column))
+        counted = model._default_manager.db_manager(db).order_by().extra(
+            where=['%s.%s = %s' % (
+                qn(counted_opts.db_table),
+                qn(counted_opts.get_field(group_by).column), outer)])
+        query = counted.query
+        query.default_cols = False
+        query.add_count_column()
+        subquery, params = query.get_compiler(db).as_sql()
+        sql = 'UPDATE %s SET %s = (%s) WHERE %s IN (%s)' % (
+            qn(opts.db_table), qn(opts.get_field(self.counter_field).column),
+            subquery, outer, ', '.join(['%s'] * len(keys)))
+        params = tuple(params) + tuple([
+            rel_field.get_db_prep_value(key, connection=connection)
+            for key in keys])
+        connection.cursor().execute(sql, params)
+        transaction.commit_unless_managed(using=db)
+
+    def adjust(self, deltas):
+        manager = self.relation.model._default_manager
+        rel_name = self.relation.rel_name
+        for key, delta in deltas.items():
+            if key is not None and delta:
+                manager.filter(**{rel_name: key}).update(
+                    **{self.counter_field: F(self.counter_field) + delta})
+
+class RelatedCountStore(RelatedCountTracker):
+    """
+    Keeps the number of objects related to each instance of `model` by the
+    field `name` in the `RelatedCount` table, and reads them back in bulk
+    with `get_counts()`.
+
+    """
+    def __init__(self, model, name):
+        RelatedCountTracker.__init__(self, model, name)
+        self.model_label = '%s.%s' % (model._meta.app_label,
+                                      model._meta.module_name)
+
+    def get_rows(self):
+        """Return a `QuerySet` of the `RelatedCount` rows for the field."""
+        return RelatedCount.objects.filter(model=self.model_label,
+                                           field=self.relation.field_name)
+
+    def get_counts(self, keys):
+        """
+        Return a dictionary mapping each of the given values of the
+        relation's `rel_name` field to its stored count, read with one query.
+        Keys without a stored count are left out.
+
+        """
+        keys = dict([(force_unicode(key), key) for key in keys])
+        rows = self.get_rows().filter(key__in=keys.keys())
+        return dict([(keys[key], count) for key, count in
+                     rows.values_list('key', 'count')])
+
+    def save_counts(self, counts):
+        rows = self.get_rows()
+        for key, count in counts.items():
+            key = force_unicode(key)
+            if not rows.filter(key=key).update(count=count):
+                RelatedCount.objects.create(model=self.model_label,
+                                            field=self.relation.field_name,
+                                            key=key, count=count)
+
+    def update_chunk(self, keys):
+        # Replace the chunk's rows with one DELETE and one batch of INSERTs.
+        counts = self.relation.count_related(keys)
+        model, field = self.model_label, self.relation.field_name
+        db = router.db_for_write(RelatedCount)
+        connection = connections[db]
+        qn = connection.ops.quote_name
+        opts = RelatedCount._meta
+        columns = [qn(opts.get_field(name).column)
+                   for name in ('model', 'field', 'key', 'count')]
+        table = qn(opts.db_table)
+        cursor = connection.cursor()
+        cursor.execute(
+            'DELETE FROM %s WHERE %s = %%s AND %s = %%s AND %s IN (%s)' % (
+                table, columns[0], columns[1], columns[2],
+                ', '.join(['%s'] * len(counts))),
+            [model, field] + [force_unicode(key) for key in counts])
+        cursor.executemany(
+            'INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)' % (
+                table, ', '.join(columns)),
+            [(model, field, force_unicode(key), count)
+             for key, count in counts.items()])
+        transaction.commit_unless_managed(using=db)
+
+    def adjust(self, deltas):
+        rows = self.get_rows()
+        for key, delta in deltas.items():
+            if key is not None and delta:
+                updated = rows.filter(key=force_unicode(key)).update(
+                    count=F('count') + delta)
+                if not updated:
+                    # Not counted yet; the count includes the change.
+                    self.update([key])
+
+    def rebuild(self):
+        self.get_rows().delete()
+        self.update_all()
+
+def connect_pending(**kwargs):
+    """
+    Connect the signal handlers of the trackers created since the last call.
+    Until then, this is connected to `pre_init`: the handlers only follow
+    changes to model instances, so connecting them when the first instance
+    is made (by which time the models are loaded) is soon enough, and
+    doesn't look up relations while `models.py` modules are imported.
+
+    """
+    _pending_lock.acquire()
+    try:
+        while pending:
+            pending[0].connect()
+            del pending[0]
+        signals.pre_init.disconnect(connect_pending)
+    finally:
+        _pending_lock.release()
+
+def connect_later(tracker):
+    """Have `connect_pending()` connect the signal handlers of `tracker`."""
+    _pending_lock.acquire()
+    try:
+        pending.append(tracker)
+        signals.pre_init.connect(connect_pending)
+    finally:
+        _pending_lock.release()
+
+def track_related_count(model, name, counter_field):
+    """
+    Keep the integer field `counter_field` of `model` equal to the number of
+    objects related to each instance by the many-to-many or one-to-many
+    field `name`, and return the `CounterFieldTracker` doing so. Call this
+    once `model` is defined, for example at the end of `models.py`; the
+    relation is looked up when the first model instance is made.
+
+    """
+    tracker = CounterFieldTracker(model, name, counter_field)
+    connect_later(tracker)
+    trackers.append(tracker)
+    return tracker
+
+def store_related_count(model, name):
+    """
+    Keep the number of objects related to each instance of `model` by the
+    many-to-many or one-to-many field `name` in the `RelatedCount` table,
+    and return the `RelatedCountStore` doing so, for passing as the
+    `count_store` of changelist columns. Call this once `model` is defined,
+    for example at the end of `models.py`; the relation is looked up when
+    the first model instance is made.
+
+    """
+    store = RelatedCountStore(model, name)
+    connect_later(store)
+    trackers.append(store)
+    return store
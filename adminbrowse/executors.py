@@ -0,0 +1,154 @@
+"""
+Executors for doing the fetch phase of several changelist columns at once.
+
+Set `AutoBrowseModelAdmin.column_executor` to a `ThreadPool` to prepare the
+columns of a changelist page concurrently:
+
+    class BookAdmin(AutoBrowseModelAdmin):
+        list_display = ['title', related_list(Book, 'categories'),
+                        link_to_changelist(Book, 'reviews')]
+        column_executor = ThreadPool(4)
+
+When the columns' queries wait on a database server over the network, the
+page then takes about as long as its slowest column rather than the sum of
+them all. Work done in Python, and queries against a local SQLite database,
+gain nothing, since only one thread runs Python code at a time.
+
+Each worker thread keeps its own database connections open between tasks,
+rolling back after every task so that no transaction is left open between
+requests, and closes them when the pool is closed. The columns therefore
+can't see changes that the request thread hasn't committed.
+
+"""
+import sys
+from threading import Thread, Lock
+from Queue import Queue
+
+from django.db import connections, transaction
+from django.core.urlresolvers import (get_urlconf, set_urlconf,
+                                      get_script_prefix, set_script_prefix)
+from django.utils.translation import get_language, activate, deactivate
+
+
+def close_connections():
+    """Close the current thread's database connections."""
+    for connection in connections.all():
+        connection.close()
+
+def end_transactions():
+    """
+    Roll back the current thread's open database transactions, keeping the
+    connections for the next task.
+
+    """
+    for alias in connections:
+        transaction.rollback_unless_managed(using=alias)
+
+def has_thread_local_database():
+    """
+    Return True if a database connection made by another thread would not
+    see the same database, as with an in-memory SQLite database.
+
+    """
+    for connection in connections.all():
+        settings = connection.settings_dict
+        if settings['ENGINE'].endswith('sqlite3') and \
+           settings['NAME'] in ('', ':memory:'):
+            return True
+    return False
+
+class ThreadPool(object):
+    """
+    A pool of at most `workers` threads with a `map()` method that calls a
+    function for each item of an iterable in the worker threads, and
+    returns a list of the results in order. The threads are started when
+    first needed.
+
+    Each task runs with the calling thread's language, URLconf and script
+    prefix. If a task raises an exception, `map()` raises it once every
+    task has finished. If there is only one item, or the database is an
+    in-memory SQLite database that other threads can't share, the items
+    are processed in the calling thread instead.
+
+    Time and queries spent in worker threads aren't recorded by
+    `adminbrowse.instrumentation`.
+
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._tasks = Queue()
+        self._threads = []
+        self._lock = Lock()
+
+    def map(self, func, iterable):
+        items = list(iterable)
+        if not self.use_threads(items):
+            return map(func, items)
+        self._start()
+        state = (get_language(), get_urlconf(), get_script_prefix())
+        results = Queue()
+        for i, item in enumerate(items):
+            self._tasks.put((func, item, i, state, results))
+        values = [None] * len(items)
+        error = None
+        for item in items:
+            i, value, exc_info = results.get()
+            values[i] = value
+            if exc_info is not None and error is None:
+                error = exc_info
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return values
+
+    def use_threads(self, items):
+        """Return True if the given items should be processed by workers."""
+        return len(items) > 1 and not has_thread_local_database()
+
+    def close(self):
+        """
+        Stop the worker threads, closing their database connections, once
+        they have finished their tasks.
+
+        """
+        self._lock.acquire()
+        try:
+            for thread in self._threads:
+                self._tasks.put(None)
+            self._threads = []
+        finally:
+            self._lock.release()
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            while len(self._threads) < self.workers:
+                thread = Thread(target=self._work,
+                                name='adminbrowse-worker-%d' %
+                                len(self._threads))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                close_connections()
+                break
+            func, item, i, (language, urlconf, prefix), results = task
+            value = exc_info = None
+            activate(language)
+            set_urlconf(urlconf)
+            set_script_prefix(prefix)
+            try:
+                try:
+                    value = func(item)
+                except:
+                    exc_info = sys.exc_info()
+            finally:
+                deactivate()
+                set_urlconf(None)
+                end_transactions()
+                results.put((i, value, exc_info))
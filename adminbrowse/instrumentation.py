@@ -0,0 +1,219 @@
+"""
+Opt-in recording of how much work each changelist column does.
+
+While recording is active for the current thread (see `start_recording()`,
+or install `adminbrowse.middleware.ColumnStatsMiddleware` to record every
+request), every call to a column's `__call__()`, `render_many()`,
+`render_text_many()` or `prefetch()` method is timed, and the SQL queries
+executed during the call are counted.
+
+The methods of `ChangeListColumn` and its subclasses are only wrapped while
+some thread is recording, so columns cost nothing extra otherwise. Column
+classes defined while recording is active aren't recorded until it next
+starts.
+
+"""
+from threading import local, Lock
+from timeit import default_timer
+
+from django.db import connections
+
+_local = local()
+
+# The column methods that are recorded, with a function returning the number
+# of cells a call renders (None for methods that don't render cells).
+instrumented_methods = [('__call__', lambda obj: 1),
+                        ('render_many', lambda objs: len(objs)),
+                        ('render_text_many', lambda objs: len(objs)),
+                        ('prefetch', None)]
+
+# The number of threads recording, and the (class, name, method) of every
+# method replaced by a wrapper while it is above zero.
+_recording_threads = 0
+_wrapped_methods = []
+_wrap_lock = Lock()
+
+
+class ColumnStats(object):
+    """The work done by a single column while recording was active."""
+    def __init__(self, column):
+        self.column = column
+        self.calls = 0
+        self.time = 0.0
+        self.queries = 0
+
+    def __repr__(self):
+        return '<ColumnStats: %s>' % self
+
+    def __str__(self):
+        return '%s;calls=%d;time=%.2fms;queries=%d' % (
+            self.name.encode('utf-8'), self.calls, self.time * 1000,
+            self.queries)
+
+    @property
+    def name(self):
+        name = getattr(self.column, 'short_description', None)
+        if name is None:
+            name = self.column.__class__.__name__
+        return unicode(name)
+
+    def as_dict(self):
+        return {'name': self.name, 'calls': self.calls, 'time': self.time,
+                'queries': self.queries}
+
+class CountingCursorWrapper(object):
+    """Cursor wrapper that counts the queries executed through it."""
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def execute(self, *args, **kwargs):
+        self.recorder.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.recorder.queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class Recorder(object):
+    def __init__(self):
+        self.stats = []
+        self.queries = 0
+        self._stats = {}
+        self._active = set()
+
+    def patch_connections(self):
+        # Database connections are thread-local, so replacing the `cursor`
+        # method on each only affects the recording thread.
+        for connection in connections.all():
+            cursor = type(connection).cursor.__get__(connection)
+            connection.cursor = self._make_cursor_function(cursor)
+
+    def unpatch_connections(self):
+        for connection in connections.all():
+            if 'cursor' in connection.__dict__:
+                del connection.cursor
+
+    def _make_cursor_function(self, cursor):
+        def counting_cursor():
+            return CountingCursorWrapper(cursor(), self)
+        return counting_cursor
+
+    def record(self, column, calls, method, *args, **kwargs):
+        key = id(column)
+        if key in self._active:
+            # Already being recorded further up the stack.
+            return method(column, *args, **kwargs)
+        try:
+            stats = self._stats[key]
+        except KeyError:
+            stats = self._stats[key] = ColumnStats(column)
+            self.stats.append(stats)
+        self._active.add(key)
+        queries = self.queries
+        start = default_timer()
+        try:
+            return method(column, *args, **kwargs)
+        finally:
+            stats.time += default_timer() - start
+            stats.queries += self.queries - queries
+            stats.calls += calls
+            self._active.remove(key)
+
+def column_classes():
+    """Return a list of `ChangeListColumn` and all of its subclasses."""
+    from adminbrowse.base import ChangeListColumn
+    classes, seen = [], set()
+    pending = [ChangeListColumn]
+    while pending:
+        cls = pending.pop()
+        if cls not in seen:
+            seen.add(cls)
+            classes.append(cls)
+            pending.extend(cls.__subclasses__())
+    return classes
+
+def wrap_column_methods():
+    """Replace the recorded methods of every column class with wrappers."""
+    for cls in column_classes():
+        for name, count_calls in instrumented_methods:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, 'instrumented',
+                                                  False):
+                setattr(cls, name, instrumented(method, count_calls))
+                _wrapped_methods.append((cls, name, method))
+
+def unwrap_column_methods():
+    """Restore the methods replaced by `wrap_column_methods()`."""
+    while _wrapped_methods:
+        cls, name, method = _wrapped_methods.pop()
+        setattr(cls, name, method)
+
+def start_recording():
+    """Start recording column statistics for the current thread."""
+    global _recording_threads
+    stop_recording()
+    _wrap_lock.acquire()
+    try:
+        if not _recording_threads:
+            wrap_column_methods()
+        _recording_threads += 1
+    finally:
+        _wrap_lock.release()
+    _local.recorder = Recorder()
+    _local.recorder.patch_connections()
+
+def stop_recording():
+    """
+    Stop recording column statistics for the current thread, and return
+    a list of `ColumnStats` for the columns that were used, in order of
+    first use.
+
+    """
+    global _recording_threads
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return []
+    recorder.unpatch_connections()
+    _local.recorder = None
+    _wrap_lock.acquire()
+    try:
+        _recording_threads -= 1
+        if not _recording_threads:
+            unwrap_column_methods()
+    finally:
+        _wrap_lock.release()
+    return recorder.stats
+
+def format_stats(stats):
+    """Return a one-line summary of `stats`, suitable for an HTTP header."""
+    return ', '.join([str(column_stats) for column_stats in stats])
+
+def instrumented(method, count_calls=None):
+    """
+    Wrap a column method so that its calls are recorded while recording is
+    active. If given, `count_calls` is called with the method's arguments
+    and returns the number of cells the call renders, which is added to
+    `ColumnStats.calls`; time and queries are recorded either way.
+
+    """
+    def wrapper(self, *args, **kwargs):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is None:
+            return method(self, *args, **kwargs)
+        if count_calls is None:
+            calls = 0
+        else:
+            calls = count_calls(*args, **kwargs)
+        return recorder.record(self, calls, method, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    wrapper.__module__ = method.__module__
+    wrapper.instrumented = True
+    return wrapper
@@ -0,0 +1,19 @@
+import sys
+
+from django.core.management.base import NoArgsCommand
+
+from adminbrowse.counters import trackers
+
+
+class Command(NoArgsCommand):
+    help = ("Recount the related objects for every relation whose counts "
+            "are kept by adminbrowse.counters.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for tracker in trackers:
+            relation = tracker.relation
+            if verbosity > 0:
+                sys.stdout.write("Recounting %s.%s\n" % (
+                    relation.model.__name__, relation.field_name))
+            tracker.rebuild()
@@ -0,0 +1,35 @@
+import logging
+
+from django.conf import settings
+
+from adminbrowse.instrumentation import (start_recording, stop_recording,
+                                         format_stats)
+from adminbrowse.signals import column_stats_recorded
+
+logger = logging.getLogger('adminbrowse')
+
+
+class ColumnStatsMiddleware(object):
+    """
+    Record the number of calls, wall time and SQL queries of every adminbrowse
+    column used while handling each request.
+
+    If any columns were used, the statistics are logged to the 'adminbrowse'
+    logger at the DEBUG level and sent with the `column_stats_recorded`
+    signal. If the `ADMINBROWSE_STATS_HEADER` setting is True, a summary is
+    also added to the response in the `X-Adminbrowse-Columns` header.
+
+    """
+    def process_request(self, request):
+        start_recording()
+
+    def process_response(self, request, response):
+        stats = stop_recording()
+        if stats:
+            summary = format_stats(stats)
+            logger.debug("%s %s", request.path, summary)
+            column_stats_recorded.send(sender=self.__class__,
+                                       request=request, stats=stats)
+            if getattr(settings, 'ADMINBROWSE_STATS_HEADER', False):
+                response['X-Adminbrowse-Columns'] = summary
+        return response
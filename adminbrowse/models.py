@@ -1,3 +1,21 @@
 from django.db import models
 
-# Create your models here.
+
+class RelatedCount(models.Model):
+    """
+    The number of objects related to the object whose `rel_name` value is
+    `key`, by the field `field` of the model `model` ("app_label.model").
+    Maintained by `adminbrowse.counters.RelatedCountStore`.
+
+    """
+    model = models.CharField(max_length=100)
+    field = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('model', 'field', 'key')]
+
+    def __unicode__(self):
+        return u"%s.%s[%s]: %d" % (self.model, self.field, self.key,
+                                   self.count)
@@ -0,0 +1,152 @@
+"""
+Counting the objects on a changelist without `COUNT(*)` over a huge table.
+
+Set `AutoBrowseModelAdmin.result_count_mode` to choose how the changelist
+counts its objects:
+
+- 'exact' (the default) counts them with `COUNT(*)`, as the admin does.
+- 'capped' counts at most `result_count_cap` of them, showing "N+" if
+  there are more.
+- 'estimated' reads the number of rows in the model's table from the
+  database's statistics, showing "~N", and falls back to a capped count
+  for filtered changelists (including those of a `ModelAdmin.queryset()`
+  that filters) or if there are no statistics (or the estimate is below
+  the cap, when counting is cheap). Statistics are read from
+  `sqlite_stat1` (kept by SQLite's `ANALYZE`), PostgreSQL's `pg_class` and
+  MySQL's `information_schema`.
+
+For example:
+
+    class BookAdmin(AutoBrowseModelAdmin):
+        result_count_mode = 'estimated'
+        result_count_cap = 10000
+
+"""
+from django.core.paginator import Paginator, Page, PageNotAnInteger, EmptyPage
+from django.db import connections, DatabaseError
+
+EXACT = 'exact'
+ESTIMATED = 'estimated'
+AT_LEAST = 'at_least'
+
+
+class ApproximateCount(int):
+    """
+    A number of objects and how accurate it is: `EXACT`, `ESTIMATED` or
+    `AT_LEAST` (there may be more). Displays as "~N" if estimated and "N+"
+    if there may be more.
+
+    """
+    def __new__(cls, value, accuracy=EXACT):
+        count = int.__new__(cls, value)
+        count.accuracy = accuracy
+        return count
+
+    def __unicode__(self):
+        if self.accuracy == ESTIMATED:
+            return u"~%d" % self
+        if self.accuracy == AT_LEAST:
+            return u"%d+" % self
+        return u"%d" % self
+
+    def __str__(self):
+        return str(unicode(self))
+
+    def __repr__(self):
+        return 'ApproximateCount(%d, %r)' % (self, self.accuracy)
+
+class CountPaginator(Paginator):
+    """
+    `Paginator` given the number of objects rather than counting them, and
+    the accuracy of that number (see `ApproximateCount`) as `accuracy`. If
+    the number isn't exact, pages past it can still be requested, and may
+    be empty.
+
+    """
+    def __init__(self, object_list, per_page, count, accuracy=None,
+                 **kwargs):
+        Paginator.__init__(self, object_list, per_page, **kwargs)
+        self._count = count
+        if accuracy is None:
+            accuracy = getattr(count, 'accuracy', EXACT)
+        self.accuracy = accuracy
+
+    def validate_number(self, number):
+        if self.accuracy == EXACT:
+            return Paginator.validate_number(self, number)
+        try:
+            number = int(number)
+        except ValueError:
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        if self.accuracy == EXACT:
+            return Paginator.page(self, number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return Page(self.object_list[bottom:bottom + self.per_page], number,
+                    self)
+
+def capped_count(queryset, cap):
+    """
+    Return the number of objects in `queryset`, reading at most `cap` + 1
+    primary keys. If there are more than `cap`, returns `cap` with the
+    accuracy `AT_LEAST`.
+
+    """
+    count = len(queryset.values_list('pk', flat=True)[:cap + 1])
+    if count > cap:
+        return ApproximateCount(cap, AT_LEAST)
+    return ApproximateCount(count)
+
+def _sqlite_estimate(cursor, table):
+    # Each row's stat starts with the number of rows in the table or index.
+    try:
+        cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s",
+                       [table])
+    except DatabaseError:
+        # ANALYZE has never been run, so there is no sqlite_stat1.
+        return None
+    counts = [int(row[0].split()[0]) for row in cursor.fetchall()]
+    return counts and max(counts) or None
+
+def _postgresql_estimate(cursor, table):
+    cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s "
+                   "AND pg_table_is_visible(oid)", [table])
+    row = cursor.fetchone()
+    # reltuples is 0 or negative if the table has never been analyzed.
+    return row and row[0] > 0 and int(row[0]) or None
+
+def _mysql_estimate(cursor, table):
+    cursor.execute("SELECT table_rows FROM information_schema.tables "
+                   "WHERE table_schema = DATABASE() AND table_name = %s",
+                   [table])
+    row = cursor.fetchone()
+    return row and row[0] is not None and int(row[0]) or None
+
+# Functions returning the estimated number of rows in a table, given a cursor
+# and the table name, by the module name of the database backend.
+estimators = {'sqlite3': _sqlite_estimate,
+              'postgresql': _postgresql_estimate,
+              'postgresql_psycopg2': _postgresql_estimate,
+              'mysql': _mysql_estimate}
+
+def estimate_count(model, using='default'):
+    """
+    Return the number of rows in the table of `model` in the database
+    `using`, according to the database's statistics, with the accuracy
+    `ESTIMATED`. Returns None if there are no statistics for it.
+
+    """
+    connection = connections[using]
+    estimator = estimators.get(
+        connection.settings_dict['ENGINE'].split('.')[-1])
+    if estimator is None:
+        return None
+    count = estimator(connection.cursor(), model._meta.db_table)
+    if count is None:
+        return None
+    return ApproximateCount(count, ESTIMATED)
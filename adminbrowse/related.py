@@ -1,11 +1,18 @@
 from django.contrib import admin
 from django.utils.text import force_unicode
 from django.utils.translation import ugettext as _
-from django.db.models import FieldDoesNotExist
-from django.core.urlresolvers import reverse
+from django.db import connection, connections
+from django.db.models import FieldDoesNotExist, Count
+from django.core.urlresolvers import reverse, get_urlconf, get_script_prefix
+from django.utils.encoding import iri_to_uri
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+from django.conf import settings
+from django.contrib.humanize.templatetags.humanize import intcomma
 
 from adminbrowse.base import (ChangeListModelFieldColumn,
-                              ChangeListTemplateColumn)
+                              ChangeListTemplateColumn, LazyMetadata,
+                              uses_builtin_template)
 
 
 def admin_view_name(model_or_instance, short_name, site=admin.site):
@@ -27,6 +34,41 @@ def admin_view_name(model_or_instance, short_name, site=admin.site):
     app_label, module_name = opts.app_label, opts.module_name
     return '%s:%s_%s_%s' % (site.name, app_label, module_name, short_name)
 
+# Maps (URLconf, script prefix, view name, has argument) to URL templates.
+_url_template_cache = {}
+_URL_PLACEHOLDER = '__adminbrowse__'
+
+def admin_url_template(view_name, has_argument=False):
+    """
+    Return a `(prefix, suffix)` tuple for building the URL of the view given
+    by `view_name` without calling `reverse()` for every changelist row. If
+    `has_argument` is True, the view takes a single positional argument,
+    which goes between the prefix and suffix (after passing it through
+    `iri_to_uri()`, as `reverse()` would); otherwise the suffix is empty.
+
+    Templates are cached for each URLconf and script prefix, so overriding
+    `ROOT_URLCONF` (as in tests) or the URLconf for the current thread does
+    not return stale URLs. Call `clear_url_template_cache()` if the patterns
+    in an already-used URLconf change.
+
+    """
+    urlconf = get_urlconf() or settings.ROOT_URLCONF
+    key = (urlconf, get_script_prefix(), view_name, has_argument)
+    try:
+        return _url_template_cache[key]
+    except KeyError:
+        if has_argument:
+            url = reverse(view_name, urlconf, args=[_URL_PLACEHOLDER])
+            prefix, suffix = url.split(_URL_PLACEHOLDER, 1)
+        else:
+            prefix, suffix = reverse(view_name, urlconf), ''
+        _url_template_cache[key] = (prefix, suffix)
+        return prefix, suffix
+
+def clear_url_template_cache():
+    """Clear the URL templates cached by `admin_url_template()`."""
+    _url_template_cache.clear()
+
 
 class ChangeLink(ChangeListTemplateColumn, ChangeListModelFieldColumn):
     """
@@ -39,86 +81,515 @@ class ChangeLink(ChangeListTemplateColumn, ChangeListModelFieldColumn):
     Include the `adminbrowse` CSS file in the ModelAdmin's `Media` definition
     to apply default styles to the link.
 
+    The `select_related` attribute lists the lookups that should be passed
+    to `QuerySet.select_related()` so that rendering the column doesn't cost
+    a query per row; `AutoBrowseModelAdmin` applies it automatically. If the
+    related object's string representation follows further relations, name
+    them (relative to the related model) with the `select_related` argument,
+    e.g. `select_related=['publisher']` for a `publisher` field on the author.
+
+    With the default `template_name`, the column renders the same HTML as
+    the "adminbrowse/link_to_change.html" template without going through
+    the template engine, unless your project overrides that template (see
+    `renders_fast()`). Set `fast_render` to True or False to decide
+    yourself.
+
     This class is aliased as `adminbrowse.link_to_change` for better
     readability in `ModelAdmin` code.
 
     """
     template_name = "adminbrowse/link_to_change.html"
+    fast_render = None
+    to_model = LazyMetadata('to_model')
+    to_opts = LazyMetadata('to_opts')
+    to_field = LazyMetadata('to_field')
+    view_name = LazyMetadata('view_name')
 
     def __init__(self, model, name, short_description=None, default="",
-                 template_name=None, extra_context=None):
+                 template_name=None, extra_context=None, select_related=None):
         ChangeListTemplateColumn.__init__(self, short_description,
                                           template_name or self.template_name,
                                           extra_context, name)
         ChangeListModelFieldColumn.__init__(self, model, name,
                                             short_description, default)
+        self.select_related = [name] + ['%s__%s' % (name, path) for path in
+                                        select_related or ()]
+
+    def _resolve(self):
+        ChangeListModelFieldColumn._resolve(self)
         self.to_model = self.field.rel.to
         self.to_opts = self.to_model._meta
         self.to_field = self.field.rel.field_name
+        self.view_name = admin_view_name(self.to_model, 'change')
 
-    def get_context(self, obj):
+    def get_context(self, obj, context=None):
         value  = getattr(obj, self.field_name)
         if value is not None:
             url = self.get_change_url(obj, value)
             title = self.get_title(obj, value)
         else:
             url = title = None
-        context = {'column': self, 'object': obj, 'value': value, 'url': url,
-                   'title': title}
-        context.update(self.extra_context)
+        if context is None:
+            context = {}
+        context['column'] = self
+        context['object'] = obj
+        context['value'] = value
+        context['url'] = url
+        context['title'] = title
+        if self.extra_context:
+            context.update(self.extra_context)
         return context
 
+    def prefetch(self, objects):
+        """
+        Fetch the related object of every object in `objects` with one query,
+        skipping objects whose related object is already cached (for example
+        by `select_related()`).
+
+        """
+        cache_name = self.field.get_cache_name()
+        attname = self.field.attname
+        keys = set([getattr(obj, attname) for obj in objects
+                    if not hasattr(obj, cache_name)])
+        keys.discard(None)
+        if not keys:
+            return
+        to_field = self.to_opts.get_field(self.to_field)
+        lookup = '%s__in' % self.to_field
+        related = self.to_model._default_manager.filter(**{lookup: list(keys)})
+        related = dict([(getattr(item, to_field.attname), item)
+                        for item in related])
+        for obj in objects:
+            key = getattr(obj, attname)
+            if key in related and not hasattr(obj, cache_name):
+                setattr(obj, cache_name, related[key])
+
+    def render_many(self, objs):
+        self.prefetch(objs)
+        return ChangeListTemplateColumn.render_many(self, objs)
+
+    def render_text(self, obj):
+        value = getattr(obj, self.field_name)
+        if value is None:
+            return force_unicode(self.default)
+        return force_unicode(value)
+
+    def renders_fast(self):
+        """
+        Return True if `render()` skips the template engine: with the
+        default `template_name`, if `fast_render` is True, or if it is None
+        and the template loaders find adminbrowse's own template.
+
+        """
+        if self.template_name != ChangeLink.template_name:
+            return False
+        if self.fast_render is None:
+            return uses_builtin_template(self.template_name)
+        return self.fast_render
+
+    def render(self, context):
+        if not self.renders_fast():
+            return ChangeListTemplateColumn.render(self, context)
+        if context['value']:
+            html = (u'\n<span class="change-link"><a href="%s" title="%s">'
+                    u'</a> %s</span>\n\n')
+            return mark_safe(html % (conditional_escape(context['url']),
+                                     conditional_escape(context['title']),
+                                     conditional_escape(context['value'])))
+        else:
+            default = conditional_escape(context['column'].default)
+            return mark_safe(u'\n%s\n\n' % default)
+
     def get_change_url(self, obj, value):
-        view_name = admin_view_name(value, 'change')
-        return reverse(view_name, args=[value.pk])
+        prefix, suffix = admin_url_template(self.view_name, True)
+        return prefix + iri_to_uri(force_unicode(value.pk)) + suffix
 
     def get_title(self, obj, value):
+        return self.get_string('title', self._get_title)
+
+    def _get_title(self):
         strings = {'field_verbose_name': self.field.verbose_name}
         return _("Go to %(field_verbose_name)s") % strings
 
-class RelatedList(ChangeListModelFieldColumn):
+class RelatedObjectsColumn(ChangeListModelFieldColumn):
     """
-    Changelist column that displays a textual list of the related objects
-    in the specified many-to-many or one-to-many field.
-
-    If an instance's has no related objects for the given field, the column
-    will display the value of `default`, which defaults to the empty string.
-
-    The `sep` argument specifies the separator to place between the string
-    representation of each object.
-
-    This class is aliased as `adminbrowse.related_list` for better
-    readability in `ModelAdmin` code.
+    Base class for changelist columns that display the related objects in
+    the specified many-to-many or one-to-many field.
+
+    By default, each row queries for its own related objects. Call
+    `prefetch()` with all of the objects on a changelist page before
+    rendering to fetch the related objects for every row with a single
+    query; `render_many()` and `AutoBrowseModelAdmin` do this automatically.
+
+    If `sortable` is True, the changelist can be sorted by the number of
+    related objects: the column asks for the changelist `QuerySet` to be
+    annotated with their `Count()` (see the `annotations` attribute), and
+    sets `admin_order_field` to the annotation. Only
+    `AutoBrowseModelAdmin` applies the annotation, so don't make columns
+    sortable in other `ModelAdmin` classes.
+
+    Counting on every page view means a `GROUP BY` over all the related
+    rows. If `counter_field` names an integer field of the model that holds
+    the number of related objects, the column reads the number from it and
+    sorts by it instead. See `adminbrowse.counters.track_related_count()`
+    for keeping the field up to date. Alternatively, `count_store` may be a
+    `RelatedCountStore` from `adminbrowse.counters.store_related_count()`,
+    which keeps the counts in a table of its own; `prefetch_counts()` reads
+    them for a whole page with one query, but can't be sorted by.
 
     """
+    to_model = LazyMetadata('to_model')
+    to_opts = LazyMetadata('to_opts')
+    query_name = LazyMetadata('query_name')
+    reverse_name = LazyMetadata('reverse_name')
+    rel_name = LazyMetadata('rel_name')
+    annotations = LazyMetadata('annotations')
+    # SQLite allows at most 500 SELECTs in a UNION, and 999 parameters.
+    union_batch_size = 200
 
     def __init__(self, model, name, short_description=None, default="",
-                 sep=", "):
+                 sortable=False, counter_field=None, count_store=None):
         ChangeListModelFieldColumn.__init__(self, model, name,
                                             short_description, default)
+        self.sortable = sortable
+        self.counter_field = counter_field
+        self.count_store = count_store
+        self.cache_name = '_adminbrowse_%s_cache' % name
+        self.count_name = '_adminbrowse_%s_count' % name
+
+    def _resolve(self):
+        ChangeListModelFieldColumn._resolve(self)
         if self.direct:
             self.to_model = self.field.related.parent_model
             self.to_opts = self.to_model._meta
-            self.reverse_name = self.field.rel.related_name
+            self.query_name = self.field.name
+            self.reverse_name = self.field.related_query_name()
             self.rel_name = self.opts.pk.name
         else:
             self.to_model = self.field.model
             self.to_opts = self.field.opts
+            self.query_name = self.field.related_query_name()
             self.reverse_name = self.field.name
             if self.m2m:
                 self.rel_name = self.field.rel.get_related_field().name
             else:
                 self.rel_name = self.field.rel.field_name
+        self.required_fields = [self.rel_name]
+        if self.counter_field is not None:
+            self.required_fields.append(self.counter_field)
+            self.admin_order_field = self.counter_field
+        elif self.sortable:
+            # Several multi-valued relations in one query multiply the rows
+            # joined for each object, so only count distinct objects.
+            self.annotations = {self.count_name: Count(self.query_name,
+                                                       distinct=True)}
+            self.admin_order_field = self.count_name
+
+    def get_related(self, obj):
+        """
+        Return a `QuerySet` of the objects related to `obj`. If the related
+        objects were fetched by `prefetch()`, the `QuerySet` is already
+        evaluated and won't query the database again.
+
+        """
+        related = getattr(obj, self.field_name).all()
+        cache = getattr(obj, self.cache_name, None)
+        if cache is not None:
+            related._result_cache = cache
+        return related
+
+    def get_known_count(self, obj):
+        """
+        Return the number of objects related to `obj` if it is known without
+        a query, from `counter_field` or the `Count()` annotation, otherwise
+        None.
+
+        """
+        if self.counter_field is not None:
+            return getattr(obj, self.counter_field)
+        return getattr(obj, self.count_name, None)
+
+    def get_count(self, obj):
+        """
+        Return the number of objects related to `obj`, counting them with a
+        query if the number isn't known.
+
+        """
+        count = self.get_known_count(obj)
+        if count is None:
+            count = self.get_related(obj).count()
+        return count
+
+    def prefetch_counts(self, objects):
+        """
+        Read the number of related objects for every object in `objects`
+        from `count_store` with one query, if there is a store, and cache
+        them on each object for `get_known_count()`.
+
+        """
+        if self.count_store is None:
+            return
+        objects = [obj for obj in objects
+                   if self.get_known_count(obj) is None]
+        if not objects:
+            return
+        counts = self.count_store.get_counts(
+            set([getattr(obj, self.rel_name) for obj in objects]))
+        for obj in objects:
+            count = counts.get(getattr(obj, self.rel_name))
+            if count is not None:
+                setattr(obj, self.count_name, count)
+
+    def prefetch(self, objects):
+        """
+        Fetch the related objects for every object in `objects` with one
+        query, and cache them on each object for `get_related()`. Objects
+        that already have cached related objects are skipped.
+
+        """
+        objects = [obj for obj in objects
+                   if not hasattr(obj, self.cache_name)]
+        if not objects:
+            return
+        keys = set([getattr(obj, self.rel_name) for obj in objects])
+        cache = self.fetch_related(keys)
+        for obj in objects:
+            setattr(obj, self.cache_name, cache[getattr(obj, self.rel_name)])
+
+    def fetch_related(self, keys, limit=None, fields=None):
+        """
+        Return a dictionary mapping each of the given values of the
+        `rel_name` field to a list of the related objects, fetched with one
+        query. If `limit` is given, only the first `limit` related objects
+        are fetched for each key, with one query for every
+        `union_batch_size` keys. If `fields` is given, the lists contain
+        tuples of the values of those fields instead of model instances.
+
+        """
+        # The related objects don't know which row they were fetched for,
+        # so select the column referring to that row with them.
+        if self.m2m:
+            table = self.field.m2m_db_table()
+            if self.direct:
+                column = self.field.m2m_column_name()
+            else:
+                column = self.field.m2m_reverse_name()
+        else:
+            table, column = self.to_opts.db_table, self.field.column
+        qn = connection.ops.quote_name
+        source = '%s.%s' % (qn(table), qn(column))
+        related = self.to_model._default_manager.extra(
+            select={'_adminbrowse_source': source})
+        if fields:
+            related = related.values_list(
+                *(tuple(fields) + ('_adminbrowse_source',)))
+        lookup = '%s__%s' % (self.reverse_name, self.rel_name)
+        if limit is None:
+            related = related.filter(**{lookup + '__in': list(keys)})
+            if fields:
+                rows = [(row[-1], row[:-1]) for row in related]
+            else:
+                rows = [(item._adminbrowse_source, item) for item in related]
+        else:
+            keys = list(keys)
+            size = self.union_batch_size
+            rows = []
+            for start in xrange(0, len(keys), size):
+                rows.extend(self.fetch_first_related(
+                    related, lookup, keys[start:start + size], limit, fields))
+        cache = dict([(key, []) for key in keys])
+        for key, item in rows:
+            cache[key].append(item)
+        return cache
+
+    def fetch_first_related(self, related, lookup, keys, limit, fields):
+        """
+        Return a list of (key, related object) pairs for the first `limit`
+        objects in `related` for each of `keys`, fetched with one query; see
+        `fetch_related()`.
+
+        """
+        # Without window functions, the only way to fetch the first few
+        # related objects for each key in one query is a UNION of one
+        # limited subquery per key.
+        parts, params = [], []
+        for i, key in enumerate(keys):
+            subquery = related.filter(**{lookup: key})[:limit]
+            compiler = subquery.query.get_compiler(subquery.db)
+            sql, subquery_params = compiler.as_sql()
+            parts.append('SELECT * FROM (%s) AS adminbrowse_%d' % (sql, i))
+            params.extend(subquery_params)
+        if not parts:
+            return []
+        sql = ' UNION ALL '.join(parts)
+        if fields:
+            # The extra select comes first in the compiled SQL.
+            cursor = connections[related.db].cursor()
+            cursor.execute(sql, params)
+            return [(row[0], tuple(row[1:])) for row in cursor.fetchall()]
+        return [(item._adminbrowse_source, item) for item in
+                self.to_model._default_manager.raw(sql, params)]
+
+    def get_count_source(self):
+        """
+        Return the model whose objects are counted to count the related
+        objects (the intermediary model, for a many-to-many relation), and
+        the name of its field holding the `rel_name` value they belong to.
+
+        """
+        if self.m2m:
+            if self.direct:
+                return (self.field.rel.through,
+                        self.field.m2m_field_name())
+            return self.field.rel.through, self.field.m2m_reverse_field_name()
+        return self.to_model, self.field.name
+
+    def count_related(self, keys):
+        """
+        Return a dictionary mapping each of the given values of the
+        `rel_name` field to the number of related objects, counted with one
+        grouped query.
+
+        """
+        model, group_by = self.get_count_source()
+        counts = model._default_manager.filter(**{
+            '%s__in' % group_by: list(keys)}).order_by().values(group_by)
+        counts = counts.annotate(adminbrowse_count=Count('pk'))
+        result = dict([(key, 0) for key in keys])
+        for row in counts:
+            result[row[group_by]] = row['adminbrowse_count']
+        return result
+
+    def render_many(self, objs):
+        self.prefetch(objs)
+        return ChangeListModelFieldColumn.render_many(self, objs)
+
+class RelatedList(RelatedObjectsColumn):
+    """
+    Changelist column that displays a textual list of the related objects
+    in the specified many-to-many or one-to-many field.
+
+    If an instance's has no related objects for the given field, the column
+    will display the value of `default`, which defaults to the empty string.
+
+    The `sep` argument specifies the separator to place between the string
+    representation of each object.
+
+    If `max_items` is given, only that many related objects are fetched and
+    listed, followed by the number of objects left out, as in
+    "a, b, c and 4,812 more". When prefetching a page, the first objects for
+    every row are fetched with a single query, and the remaining objects
+    are counted with one more query if any row has more than `max_items`.
+
+    By default, each related object is displayed using its string
+    representation, which means fetching and instantiating the whole
+    object. If `display_field` names a field (or a list of fields) of the
+    related model, only the values of those fields are fetched, and each
+    object is displayed as its values separated by spaces.
+
+    The `sortable`, `counter_field` and `count_store` arguments are
+    described in `RelatedObjectsColumn`; with `max_items`, the number of
+    objects left out is then taken from the annotation, counter field or
+    store.
+
+    This class is aliased as `adminbrowse.related_list` for better
+    readability in `ModelAdmin` code.
+
+    """
+
+    def __init__(self, model, name, short_description=None, default="",
+                 sep=", ", max_items=None, display_field=None, sortable=False,
+                 counter_field=None, count_store=None):
+        RelatedObjectsColumn.__init__(self, model, name, short_description,
+                                      default, sortable, counter_field,
+                                      count_store)
         self.sep = sep
+        self.max_items = max_items
+        if isinstance(display_field, basestring):
+            display_field = [display_field]
+        self.display_fields = display_field and tuple(display_field) or None
+        # Don't share the cache with columns that fetch something else.
+        cache_key = [name]
+        if self.display_fields:
+            cache_key.append('_'.join(self.display_fields))
+        if max_items is not None:
+            cache_key.append('first_%d' % max_items)
+        self.cache_name = '_adminbrowse_%s_cache' % '__'.join(cache_key)
 
     def __call__(self, obj):
-        related = getattr(obj, self.field_name).all()
-        if related:
-            return self.sep.join(map(force_unicode, related))
+        items, count = self.get_items(obj)
+        if items:
+            text = self.sep.join(map(self.get_item_text, items))
+            if count is not None and count > len(items):
+                text = self.get_more_text(text, count - len(items))
+            return text
         else:
             return self.default
 
-class ChangeListLink(ChangeListTemplateColumn, ChangeListModelFieldColumn):
+    def get_items(self, obj):
+        """
+        Return a tuple of a list of the related objects to display for `obj`
+        (or tuples of their `display_field` values), and the total number of
+        related objects if `max_items` is set, otherwise None.
+
+        """
+        items = getattr(obj, self.cache_name, None)
+        if items is None:
+            related = getattr(obj, self.field_name).all()
+            if self.display_fields:
+                related = related.values_list(*self.display_fields)
+            if self.max_items is not None:
+                related = related[:self.max_items]
+            items = list(related)
+        if self.max_items is None:
+            return items, None
+        count = self.get_known_count(obj)
+        if count is None:
+            if len(items) < self.max_items:
+                count = len(items)
+            else:
+                count = getattr(obj, self.field_name).count()
+        return items, count
+
+    def get_item_text(self, item):
+        if self.display_fields:
+            return u" ".join(map(force_unicode, item))
+        return force_unicode(item)
+
+    def get_more_text(self, text, more):
+        strings = {'list': text, 'count': intcomma(more)}
+        return _("%(list)s and %(count)s more") % strings
+
+    def prefetch(self, objects):
+        """
+        Fetch the items to display for every object in `objects` with one
+        query (plus one to count the related objects if `max_items` is set
+        and reached, unless the counts are already known), and cache them on
+        each object.
+
+        """
+        objects = [obj for obj in objects
+                   if not hasattr(obj, self.cache_name)]
+        if not objects:
+            return
+        keys = set([getattr(obj, self.rel_name) for obj in objects])
+        cache = self.fetch_related(keys, self.max_items, self.display_fields)
+        if self.max_items is not None:
+            self.prefetch_counts(objects)
+            uncounted = [obj for obj in objects
+                         if self.get_known_count(obj) is None]
+            full = set([getattr(obj, self.rel_name) for obj in uncounted])
+            full = [key for key in full if len(cache[key]) == self.max_items]
+            counts = full and self.count_related(full) or {}
+        else:
+            uncounted = []
+        for obj in objects:
+            setattr(obj, self.cache_name, cache[getattr(obj, self.rel_name)])
+        for obj in uncounted:
+            key = getattr(obj, self.rel_name)
+            setattr(obj, self.count_name, counts.get(key, len(cache[key])))
+
+class ChangeListLink(ChangeListTemplateColumn, RelatedObjectsColumn):
     """
     Changelist column that adds a link to a changelist view containing only
     the related objects in the specified many-to-many or one-to-many field.
@@ -130,6 +601,21 @@ class ChangeListLink(ChangeListTemplateColumn, ChangeListModelFieldColumn):
     number of items in the `QuerySet`, so no link will be displayed if there
     are no related objects.
 
+    If `count` is True, the related objects are never loaded: the column
+    only needs their number, which `AutoBrowseModelAdmin` fetches for the
+    whole page by annotating the changelist `QuerySet` with `Count()` (see
+    the `annotations` attribute). Without the annotation, each row runs a
+    `COUNT` query instead. In this mode a callable `text` is called with the
+    number of related objects instead of a `QuerySet`. Giving
+    `counter_field` or `count_store` implies this mode; see
+    `RelatedObjectsColumn` for them and for `sortable`.
+
+    With the default `template_name`, the column renders the same HTML as
+    the "adminbrowse/link_to_changelist.html" template without going through
+    the template engine, unless your project overrides that template (see
+    `renders_fast()`). Set `fast_render` to True or False to decide
+    yourself.
+
     Include the `adminbrowse` CSS file in the ModelAdmin's `Media` definition
     to apply default styles to the link.
 
@@ -138,51 +624,122 @@ class ChangeListLink(ChangeListTemplateColumn, ChangeListModelFieldColumn):
 
     """
     template_name = "adminbrowse/link_to_changelist.html"
+    fast_render = None
+    view_name = LazyMetadata('view_name')
+    lookup_kwarg = LazyMetadata('lookup_kwarg')
 
     def __init__(self, model, name, short_description=None, text=len,
-                 default="", template_name=None, extra_context=None):
+                 default="", template_name=None, extra_context=None,
+                 count=False, sortable=False, counter_field=None,
+                 count_store=None):
         ChangeListTemplateColumn.__init__(self, short_description,
                                           template_name or self.template_name,
                                           extra_context)
-        ChangeListModelFieldColumn.__init__(self, model, name,
-                                            short_description, default)
-        if self.direct:
-            self.to_model = self.field.related.parent_model
-            self.to_opts = self.to_model._meta
-            self.reverse_name = self.field.rel.related_name
-            self.rel_name = self.opts.pk.name
-        else:
-            self.to_model = self.field.model
-            self.to_opts = self.field.opts
-            self.reverse_name = self.field.name
-            if self.m2m:
-                self.rel_name = self.field.rel.get_related_field().name
-            else:
-                self.rel_name = self.field.rel.field_name
+        RelatedObjectsColumn.__init__(self, model, name, short_description,
+                                      default, sortable, counter_field,
+                                      count_store)
+        self.count = count = count or counter_field is not None or \
+                             count_store is not None
+        if count and text is len:
+            # The length of the related objects is just the count.
+            text = int
         self.text = text
 
-    def get_context(self, obj):
-        value  = getattr(obj, self.field_name).all()
+    def _resolve(self):
+        RelatedObjectsColumn._resolve(self)
+        self.view_name = admin_view_name(self.to_model, 'changelist')
+        self.lookup_kwarg = '%s__%s__exact' % (self.reverse_name,
+                                               self.rel_name)
+        if self.count and self.counter_field is None and \
+           self.count_store is None:
+            self.annotations = {self.count_name: Count(self.query_name,
+                                                       distinct=True)}
+
+    def prefetch(self, objects):
+        if self.count:
+            self.prefetch_counts(objects)
+        else:
+            RelatedObjectsColumn.prefetch(self, objects)
+
+    def render_many(self, objs):
+        self.prefetch(objs)
+        return ChangeListTemplateColumn.render_many(self, objs)
+
+    def render_text(self, obj):
+        value, text = self.get_value_and_text(obj)
+        if not text:
+            return force_unicode(self.default)
+        return force_unicode(text)
+
+    def get_value_and_text(self, obj):
+        """
+        Return the related objects (or their number, in `count` mode) for
+        `obj`, and the link text.
+
+        """
+        if self.count:
+            value = self.get_count(obj)
+        else:
+            value = self.get_related(obj)
         text = self.text
         if callable(text):
             text = text(value)
+        return value, text
+
+    def get_context(self, obj, context=None):
+        value, text = self.get_value_and_text(obj)
         if text:
             url = self.get_changelist_url(obj, value)
             title = self.get_title(obj, value)
         else:
             url = title = None
-        context = {'column': self, 'object': obj, 'value': value,
-                   'text': text, 'url': url, 'title': title}
-        context.update(self.extra_context)
+        if context is None:
+            context = {}
+        context['column'] = self
+        context['object'] = obj
+        context['value'] = value
+        context['text'] = text
+        context['url'] = url
+        context['title'] = title
+        if self.extra_context:
+            context.update(self.extra_context)
         return context
 
+    def renders_fast(self):
+        """
+        Return True if `render()` skips the template engine: with the
+        default `template_name`, if `fast_render` is True, or if it is None
+        and the template loaders find adminbrowse's own template.
+
+        """
+        if self.template_name != ChangeListLink.template_name:
+            return False
+        if self.fast_render is None:
+            return uses_builtin_template(self.template_name)
+        return self.fast_render
+
+    def render(self, context):
+        if not self.renders_fast():
+            return ChangeListTemplateColumn.render(self, context)
+        if context['text']:
+            html = (u'\n<span class="changelist-link"><a href="%s" title="%s">'
+                    u'%s</a></span>\n\n')
+            return mark_safe(html % (conditional_escape(context['url']),
+                                     conditional_escape(context['title']),
+                                     conditional_escape(context['text'])))
+        else:
+            default = conditional_escape(context['column'].default)
+            return mark_safe(u'\n%s\n\n' % default)
+
     def get_changelist_url(self, obj, value):
-        view_name = admin_view_name(self.to_model, 'changelist')
-        lookup_kwarg = '%s__%s__exact' % (self.reverse_name, self.rel_name)
+        prefix, suffix = admin_url_template(self.view_name)
         lookup_id = getattr(obj, self.rel_name)
-        return reverse(view_name) + '?%s=%s' % (lookup_kwarg, lookup_id)
+        return prefix + '?%s=%s' % (self.lookup_kwarg, lookup_id)
 
     def get_title(self, obj, value):
+        return self.get_string('title', self._get_title)
+
+    def _get_title(self):
         strings = {
             'related_verbose_name_plural': self.to_opts.verbose_name_plural,
             'object_verbose_name': self.opts.verbose_name if self.m2m else
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# Sent by ColumnStatsMiddleware after each request in which columns were
+# used. `stats` is a list of adminbrowse.instrumentation.ColumnStats.
+column_stats_recorded = Signal(providing_args=["request", "stats"])
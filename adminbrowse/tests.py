@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
-from django.test import TestCase
-from django.db import models
+import copy
+from threading import Thread
+
+from django.test import TestCase, TransactionTestCase
+from django.db import models, connection, transaction
 from django.contrib import admin
 from django.contrib.auth.models import User, Group
 from django.contrib.admin.models import LogEntry
 from django.conf.urls.defaults import *
 from django.core.management import call_command
+from django.utils.translation import activate, deactivate, get_language
 
 from adminbrowse import (link_to_change, link_to_changelist, related_list,
-                         link_to_url, truncated_field, AutoBrowseModelAdmin)
+                         link_to_url, truncated_field, AutoBrowseModelAdmin,
+                         ChangeListColumn, template_column)
+from adminbrowse.base import (clear_string_caches,
+                              clear_builtin_template_cache)
+from adminbrowse.admin import (select_related_plan, only_plan, RenderedColumn,
+                               prepare_columns, clear_changelist_plans,
+                               keyset_lookup, BrowseChangeList)
+from adminbrowse.instrumentation import (start_recording, stop_recording,
+                                         format_stats)
+from adminbrowse.middleware import ColumnStatsMiddleware
+from adminbrowse.signals import column_stats_recorded
+from adminbrowse.related import admin_url_template, clear_url_template_cache
+from adminbrowse.counters import (track_related_count, store_related_count,
+                                  trackers)
+from adminbrowse.executors import ThreadPool, has_thread_local_database
+from adminbrowse.models import RelatedCount
+from adminbrowse.views import export_rows, export_response, export_as_csv
+from adminbrowse.paginators import (ApproximateCount, capped_count,
+                                    estimate_count)
 
 
 # Test models that will give the functionality under test good coverage.
@@ -17,6 +39,7 @@ class Person(models.Model):
     pid = models.AutoField(primary_key=True)
     name = models.CharField(max_length=75)
     website = models.URLField("home page", blank=True)
+    book_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         app_label = 'adminbrowse'
@@ -27,6 +50,7 @@ class Person(models.Model):
 class Genre(models.Model):
     gid = models.AutoField(primary_key=True)
     label = models.CharField(max_length=75)
+    book_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         app_label = 'adminbrowse'
@@ -47,6 +71,29 @@ class Book(models.Model):
     def __unicode__(self):
         return self.title
 
+class Shelf(models.Model):
+    label = models.CharField(max_length=75)
+    books = models.ManyToManyField(Book, through='Placement',
+                                   related_name='shelves')
+    book_count = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        app_label = 'adminbrowse'
+
+class Placement(models.Model):
+    shelf = models.ForeignKey(Shelf)
+    book = models.ForeignKey(Book)
+
+    class Meta:
+        app_label = 'adminbrowse'
+
+count_trackers = [track_related_count(Person, 'bibliography', 'book_count'),
+                  track_related_count(Genre, 'collection', 'book_count'),
+                  track_related_count(Shelf, 'books', 'book_count')]
+shelves_counts = store_related_count(Book, 'shelves')
+bibliography_counts = store_related_count(Person, 'bibliography')
+categories_counts = store_related_count(Book, 'categories')
+
 test_site = admin.AdminSite('test')
 test_site.register(Person)
 test_site.register(Genre)
@@ -61,12 +108,25 @@ def setup_test_models(sender, **kwargs):
     import adminbrowse.models
     if sender is adminbrowse.models and not setup_test_models.done:
         setup_test_models.done = True
-        for model in [Person, Genre, Book]:
+        for model in [Person, Genre, Book, Shelf, Placement]:
             setattr(adminbrowse.models, model.__name__, model)
         call_command('syncdb')
 setup_test_models.done = False
 models.signals.post_syncdb.connect(setup_test_models)
 
+def count_queries(func, *args, **kwargs):
+    """Return the number of queries executed by calling `func`."""
+    from django.conf import settings
+    from django.db import connection, reset_queries
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    reset_queries()
+    try:
+        func(*args, **kwargs)
+        return len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+
 class TestChangeLink(TestCase):
     urls = 'adminbrowse.tests'
     fixtures = ['test_adminbrowse.json']
@@ -413,6 +473,7 @@ class TestAutoBrowseModelAdmin(TestCase):
                 css = {'all': ['test.css']}
 
         self.model_admin = BookAdmin(Book, test_site)
+        self.model_admin.load_changelist_plan()
         self.media_url = settings.ADMINBROWSE_MEDIA_URL
 
     def test_has_css_media(self):
@@ -435,3 +496,1341 @@ class TestAutoBrowseModelAdmin(TestCase):
         self.assertEqual(field.model, Book)
         self.assertEqual(field.field_name, 'loc_url')
 
+    def test_select_related_includes_change_link_fields(self):
+        self.assertEqual(self.model_admin.select_related, ('author',))
+
+    def test_changelist_plan_uses_fixed_number_of_queries(self):
+        column = self.model_admin.list_display[2]
+        qs = self.model_admin.apply_changelist_plan(Book.objects.all())
+        render = lambda: [column(book) for book in qs]
+        self.assertEqual(count_queries(render), 1)
+
+class TestLazyChangeListPlan(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.column = link_to_change(Book, 'author')
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', self.column, 'loc_url']
+        self.model_admin = BookAdmin(Book, test_site)
+
+    def test_registering_does_not_build_plan(self):
+        self.assertEqual(self.model_admin._changelist_plan, None)
+        self.assertEqual(self.model_admin.list_display[3], 'loc_url')
+        self.assertFalse(self.column._resolved)
+
+    def test_plan_is_built_on_first_use(self):
+        plan = self.model_admin.load_changelist_plan()
+        self.assertTrue(self.column._resolved)
+        self.assertTrue(isinstance(self.model_admin.list_display[3],
+                                   link_to_url))
+        self.assertTrue(self.model_admin.load_changelist_plan() is plan)
+
+class TestSelectRelatedPlan(TestCase):
+    def test_nested_lookups_are_prefixed_with_field_name(self):
+        link = link_to_change(Book, 'author', select_related=['publisher'])
+        self.assertEqual(link.select_related, ['author', 'author__publisher'])
+
+    def test_implied_lookups_are_dropped(self):
+        columns = [link_to_change(Book, 'author'),
+                   link_to_change(Book, 'author', select_related=['x__y']),
+                   link_to_url(Book, 'loc_url'), 'title']
+        self.assertEqual(select_related_plan(columns), ('author__x__y',))
+
+class TestPrefetchRelatedObjects(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def assertPrefetchMatches(self, column, objects):
+        expected = [column(obj) for obj in objects]
+        objects = list(objects.model._default_manager.all())
+        self.assertEqual(count_queries(column.prefetch, objects), 1)
+        render = lambda: self.assertEqual(map(column, objects), expected)
+        self.assertEqual(count_queries(render), 0)
+
+    def test_one_to_many_related_list(self):
+        self.assertPrefetchMatches(related_list(Person, 'bibliography'),
+                                   Person.objects.all())
+
+    def test_direct_many_to_many_related_list(self):
+        self.assertPrefetchMatches(related_list(Book, 'categories'),
+                                   Book.objects.all())
+
+    def test_indirect_many_to_many_related_list(self):
+        self.assertPrefetchMatches(related_list(Genre, 'collection'),
+                                   Genre.objects.all())
+
+    def test_one_to_many_changelist_link(self):
+        self.assertPrefetchMatches(link_to_changelist(Person, 'bibliography'),
+                                   Person.objects.all())
+
+    def test_direct_many_to_many_changelist_link(self):
+        self.assertPrefetchMatches(link_to_changelist(Book, 'categories'),
+                                   Book.objects.all())
+
+    def test_prefetched_objects_are_not_fetched_again(self):
+        column = related_list(Book, 'categories')
+        books = list(Book.objects.all())
+        column.prefetch(books)
+        self.assertEqual(count_queries(column.prefetch, books), 0)
+
+class TestCountChangeListLink(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.link = link_to_changelist(Person, 'bibliography', count=True)
+        self.people = Person.objects.annotate(**self.link.annotations)
+
+    def test_call_returns_html(self):
+        url = "/foo/admin/bar/adminbrowse/book/?author__pid__exact=2"
+        title = "List books with this author"
+        self.assertEqual(self.link(self.people[1]).strip(),
+            '<span class="changelist-link"><a href="%s" title="%s">3</a>'
+            '</span>' % (url, title))
+
+    def test_html_for_empty_set_defaults_to_empty_string(self):
+        self.assertEqual(self.link(self.people[0]).strip(), "")
+
+    def test_annotated_count_uses_no_queries_per_row(self):
+        render = lambda: [self.link(person) for person in self.people]
+        self.assertEqual(count_queries(render), 1)
+
+    def test_unannotated_count_matches(self):
+        self.assertEqual(self.link.get_count(Person.objects.get(pk=2)), 3)
+
+    def test_callable_text_gets_called_with_count(self):
+        link = link_to_changelist(Genre, 'collection', count=True,
+                                  text=lambda x: "List books (%s)" % x)
+        genre = Genre.objects.annotate(**link.annotations).get(pk=1)
+        self.assertTrue('List books (3)' in link(genre))
+
+class TestAdminURLTemplate(TestCase):
+    urls = 'adminbrowse.tests'
+
+    def tearDown(self):
+        clear_url_template_cache()
+
+    def test_template_with_argument_surrounds_argument(self):
+        self.assertEqual(admin_url_template('test:adminbrowse_person_change',
+                                            True),
+                         ('/foo/admin/bar/adminbrowse/person/', '/'))
+
+    def test_template_without_argument_is_full_url(self):
+        view_name = 'test:adminbrowse_book_changelist'
+        self.assertEqual(admin_url_template(view_name),
+                         ('/foo/admin/bar/adminbrowse/book/', ''))
+
+    def test_templates_are_cached_per_urlconf(self):
+        from django.conf import settings
+        admin_url_template('test:adminbrowse_book_changelist')
+        urlconf = settings.ROOT_URLCONF
+        settings.ROOT_URLCONF = 'adminbrowse.urls_that_do_not_exist'
+        try:
+            self.assertRaises(ImportError, admin_url_template,
+                              'test:adminbrowse_book_changelist')
+        finally:
+            settings.ROOT_URLCONF = urlconf
+
+class TestFastRender(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def assertRendersLikeTemplate(self, column, objects):
+        slow_column = copy.copy(column)
+        slow_column.fast_render = False
+        for obj in objects:
+            self.assertEqual(column(obj), slow_column(obj))
+
+    def test_change_link_matches_template(self):
+        self.assertRendersLikeTemplate(
+            link_to_change(Book, 'author', default="<Unknown>"),
+            Book.objects.all())
+
+    def test_changelist_link_matches_template(self):
+        self.assertRendersLikeTemplate(
+            link_to_changelist(Person, 'bibliography', default="<None>"),
+            Person.objects.all())
+
+    def test_custom_template_name_uses_template(self):
+        template_name = "adminbrowse/link_to_changelist.html"
+        link = link_to_change(Book, 'author', template_name=template_name)
+        self.assertEqual(link(Book.objects.all()[0]).strip(), "")
+        self.assertNotEqual(link.template, None)
+
+    def test_builtin_templates_render_fast(self):
+        self.assertTrue(link_to_change(Book, 'author').renders_fast())
+        self.assertTrue(link_to_changelist(Person,
+                                           'bibliography').renders_fast())
+
+    def test_overridden_template_is_used(self):
+        import os, shutil, tempfile
+        from django.conf import settings
+        template_dirs = settings.TEMPLATE_DIRS
+        path = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(path, 'adminbrowse'))
+            open(os.path.join(path, 'adminbrowse', 'link_to_change.html'),
+                 'w').write("custom {{ value }}")
+            settings.TEMPLATE_DIRS = (path,)
+            clear_builtin_template_cache()
+            link = link_to_change(Book, 'author')
+            self.assertFalse(link.renders_fast())
+            self.assertEqual(link(Book.objects.get(pk=1)),
+                             "custom Ernest Hemingway")
+        finally:
+            settings.TEMPLATE_DIRS = template_dirs
+            clear_builtin_template_cache()
+            shutil.rmtree(path)
+
+class TestTemplateCache(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.link = link_to_change(Book, 'author')
+        self.link.fast_render = False
+        self.books = Book.objects.all()
+
+    def test_template_is_loaded_once(self):
+        self.link(self.books[0])
+        template = self.link.template
+        self.link(self.books[1])
+        self.assertTrue(self.link.template is template)
+
+    def test_reset_template_loads_template_again(self):
+        self.link(self.books[0])
+        self.link.reset_template()
+        self.assertEqual(self.link.template, None)
+        self.link(self.books[1])
+        self.assertNotEqual(self.link.template, None)
+
+    def test_context_does_not_leak_between_rows(self):
+        first = self.link(self.books[1])
+        self.link(self.books[5])
+        self.assertEqual(self.link(self.books[1]), first)
+        self.assertEqual(len(self.link._local.context.dicts), 1)
+
+class TestCachedStrings(TestCase):
+    def setUp(self):
+        self.column = link_to_url(Person, 'website')
+        self.calls = []
+
+    def test_string_is_cached(self):
+        self.column.get_string('test', lambda: self.calls.append(1) or "a")
+        self.column.get_string('test', lambda: self.calls.append(1) or "b")
+        self.assertEqual(self.calls, [1])
+
+    def test_strings_are_cached_per_language(self):
+        activate('en')
+        try:
+            self.assertEqual(self.column.get_string('test', get_language),
+                             'en')
+            activate('de')
+            self.assertEqual(self.column.get_string('test', get_language),
+                             'de')
+        finally:
+            deactivate()
+
+    def test_clear_string_caches_invalidates_strings(self):
+        self.column.get_string('test', lambda: "old")
+        clear_string_caches()
+        self.assertEqual(self.column.get_string('test', lambda: "new"), "new")
+
+    def test_title_depends_on_target(self):
+        self.assertEqual(self.column.get_title(None, None),
+                         "Open URL in a new window")
+        self.column.target = 'test'
+        self.assertEqual(self.column.get_title(None, None), "Open URL")
+
+class TestInstrumentation(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.people = list(Person.objects.all())
+        self.column = related_list(Person, 'bibliography')
+
+    def tearDown(self):
+        stop_recording()
+
+    def test_records_calls_and_queries(self):
+        start_recording()
+        for person in self.people:
+            self.column(person)
+        stats = stop_recording()
+        self.assertEqual(len(stats), 1)
+        self.assertTrue(stats[0].column is self.column)
+        self.assertEqual(stats[0].calls, 3)
+        self.assertEqual(stats[0].queries, 3)
+
+    def test_prefetch_queries_are_recorded_without_calls(self):
+        start_recording()
+        self.column.prefetch(self.people)
+        for person in self.people:
+            self.column(person)
+        stats = stop_recording()
+        self.assertEqual(stats[0].calls, 3)
+        self.assertEqual(stats[0].queries, 1)
+
+    def test_nothing_is_recorded_when_not_recording(self):
+        self.column(self.people[0])
+        self.assertEqual(stop_recording(), [])
+
+    def test_format_stats(self):
+        start_recording()
+        self.column(self.people[0])
+        summary = format_stats(stop_recording())
+        self.assertTrue(summary.startswith('bibliography;calls=1;time='))
+        self.assertTrue(summary.endswith(';queries=1'))
+
+    def test_methods_are_only_wrapped_while_recording(self):
+        method = related_list.__dict__['__call__']
+        self.assertFalse(getattr(method, 'instrumented', False))
+        start_recording()
+        self.assertTrue(related_list.__dict__['__call__'].instrumented)
+        stop_recording()
+        self.assertTrue(related_list.__dict__['__call__'] is method)
+
+    def test_subclasses_are_recorded(self):
+        class Column(ChangeListColumn):
+            def __call__(self, obj):
+                return u"%s" % obj
+        self.assertTrue(type(Column) is type)
+        start_recording()
+        Column("column")(self.people[0])
+        stats = stop_recording()
+        self.assertEqual(stats[0].calls, 1)
+
+class TestColumnStatsMiddleware(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        from django.conf import settings
+        self.settings = settings
+        self.header_setting = getattr(settings, 'ADMINBROWSE_STATS_HEADER',
+                                      False)
+        settings.ADMINBROWSE_STATS_HEADER = True
+        self.middleware = ColumnStatsMiddleware()
+        self.received = []
+        column_stats_recorded.connect(self.receive)
+
+    def tearDown(self):
+        self.settings.ADMINBROWSE_STATS_HEADER = self.header_setting
+        column_stats_recorded.disconnect(self.receive)
+
+    def receive(self, sender, request, stats, **kwargs):
+        self.received.append(stats)
+
+    def test_adds_header_and_sends_signal(self):
+        from django.http import HttpRequest, HttpResponse
+        request = HttpRequest()
+        self.middleware.process_request(request)
+        link_to_url(Person, 'website')(Person.objects.get(pk=1))
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertTrue(response['X-Adminbrowse-Columns'].startswith(
+            'home page;calls=1;'))
+        self.assertEqual(len(self.received), 1)
+
+    def test_no_header_without_columns(self):
+        from django.http import HttpRequest, HttpResponse
+        request = HttpRequest()
+        self.middleware.process_request(request)
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('X-Adminbrowse-Columns'))
+        self.assertEqual(self.received, [])
+
+class TestRenderMany(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def assertRendersLikeCall(self, column, objects, queries):
+        expected = [column(obj) for obj in objects]
+        objects = list(objects.model._default_manager.all())
+        render = lambda: self.assertEqual(column.render_many(objects),
+                                          expected)
+        self.assertEqual(count_queries(render), queries)
+
+    def test_change_link(self):
+        self.assertRendersLikeCall(link_to_change(Book, 'author'),
+                                   Book.objects.all(), 1)
+
+    def test_related_list(self):
+        self.assertRendersLikeCall(related_list(Book, 'categories'),
+                                   Book.objects.all(), 1)
+
+    def test_changelist_link(self):
+        self.assertRendersLikeCall(link_to_changelist(Genre, 'collection'),
+                                   Genre.objects.all(), 1)
+
+    def test_url_column(self):
+        self.assertRendersLikeCall(link_to_url(Person, 'website'),
+                                   Person.objects.all(), 0)
+
+    def test_truncated_field(self):
+        self.assertRendersLikeCall(truncated_field(Book, 'title', 10),
+                                   Book.objects.all(), 0)
+
+    def test_template_columns_reuse_one_context(self):
+        column = link_to_change(Book, 'author', extra_context={'x': 1})
+        contexts = []
+        get_context = column.get_context
+        def recording_get_context(obj, context=None):
+            context = get_context(obj, context)
+            contexts.append(id(context))
+            return context
+        column.get_context = recording_get_context
+        self.assertRendersLikeCall(column, Book.objects.all(), 1)
+        self.assertEqual(len(set(contexts[-Book.objects.count():])), 1)
+
+    def test_old_style_get_context_is_supported(self):
+        class AuthorColumn(template_column):
+            template_name = 'adminbrowse/link_to_change.html'
+
+            def get_context(self, obj):
+                context = template_column.get_context(self, obj)
+                context.update(url='/author/', value=obj.author)
+                return context
+
+        column = AuthorColumn("Author")
+        books = list(Book.objects.all())
+        self.assertEqual(column.render_many(books),
+                         [column(book) for book in books])
+        self.assertTrue(u'%s</span>' % books[0].author
+                        in column.render_many(books)[0])
+
+class TestRenderedColumn(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.column = related_list(Person, 'bibliography')
+        self.people = list(Person.objects.all())
+        self.rendered = RenderedColumn(self.column, self.people)
+
+    def test_returns_rendered_cells(self):
+        render = lambda: [self.rendered(person) for person in self.people]
+        self.assertEqual(count_queries(render), 0)
+        self.assertEqual(self.rendered(self.people[2]),
+                         "Cat's Cradle, Slaughterhouse-Five")
+
+    def test_other_objects_are_rendered_by_column(self):
+        person = Person.objects.get(pk=3)
+        self.assertEqual(self.rendered(person),
+                         "Cat's Cradle, Slaughterhouse-Five")
+
+    def test_attributes_come_from_column(self):
+        self.assertEqual(self.rendered.short_description, u"bibliography")
+        self.assertEqual(self.rendered.allow_tags, False)
+
+class TestLimitedRelatedList(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.column = related_list(Person, 'bibliography', max_items=2)
+        self.people = list(Person.objects.all())
+
+    def test_call_summarizes_remaining_objects(self):
+        self.assertEqual(self.column(self.people[1]),
+            "For Whom the Bell Tolls, A Farewell to Arms and 1 more")
+
+    def test_call_lists_objects_within_limit(self):
+        self.assertEqual(self.column(self.people[2]),
+                         "Cat's Cradle, Slaughterhouse-Five")
+
+    def test_default_for_empty_set(self):
+        self.assertEqual(self.column(self.people[0]), "")
+
+    def test_prefetch_matches_call(self):
+        expected = map(self.column, self.people)
+        people = list(Person.objects.all())
+        self.assertEqual(count_queries(self.column.prefetch, people), 2)
+        render = lambda: self.assertEqual(map(self.column, people), expected)
+        self.assertEqual(count_queries(render), 0)
+
+    def test_fetch_more_keys_than_a_union_allows(self):
+        keys = range(1, 602)
+        fetch = lambda: self.column.fetch_related(keys, 2)
+        self.assertEqual(count_queries(fetch), 4)
+        cache = fetch()
+        self.assertEqual(len(cache), 601)
+        self.assertEqual([book.pk for book in cache[2]], [1, 2])
+        self.assertEqual(cache[600], [])
+        cache = self.column.fetch_related(keys, 2, ['title'])
+        self.assertEqual(cache[3], [(u"Cat's Cradle",),
+                                    (u"Slaughterhouse-Five",)])
+
+    def test_many_to_many_prefetch_matches_call(self):
+        column = related_list(Genre, 'collection', max_items=1)
+        expected = map(column, Genre.objects.all())
+        genres = list(Genre.objects.all())
+        column.prefetch(genres)
+        render = lambda: self.assertEqual(map(column, genres), expected)
+        self.assertEqual(count_queries(render), 0)
+
+class TestDisplayFieldRelatedList(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.books = list(Book.objects.all())
+        self.column = related_list(Book, 'categories', display_field='label')
+
+    def test_call_returns_comma_separated_values(self):
+        self.assertEqual(self.column(self.books[4]), "War, Science Fiction")
+
+    def test_multiple_fields_are_joined_with_spaces(self):
+        column = related_list(Person, 'bibliography',
+                              display_field=['bid', 'title'])
+        self.assertEqual(column(Person.objects.get(pk=3)),
+                         "4 Cat's Cradle, 5 Slaughterhouse-Five")
+
+    def test_prefetch_matches_call(self):
+        expected = map(self.column, self.books)
+        books = list(Book.objects.all())
+        self.assertEqual(count_queries(self.column.prefetch, books), 1)
+        render = lambda: self.assertEqual(map(self.column, books), expected)
+        self.assertEqual(count_queries(render), 0)
+
+    def test_limited_prefetch_matches_call(self):
+        column = related_list(Genre, 'collection', display_field='title',
+                              max_items=2)
+        expected = map(column, Genre.objects.all())
+        genres = list(Genre.objects.all())
+        column.prefetch(genres)
+        render = lambda: self.assertEqual(map(column, genres), expected)
+        self.assertEqual(count_queries(render), 0)
+
+class TestOnlyPlan(TestCase):
+    def test_fields_needed_by_columns(self):
+        columns = ['action_checkbox', 'title', 'categories',
+                   link_to_change(Book, 'author'),
+                   truncated_field(Book, 'loc_url', 10),
+                   related_list(Book, 'categories')]
+        self.assertEqual(only_plan(Book, columns),
+                         ('author', 'bid', 'loc_url', 'title'))
+
+    def test_reverse_relation_needs_related_field(self):
+        columns = ['name', link_to_changelist(Person, 'bibliography')]
+        self.assertEqual(only_plan(Person, columns), ('name', 'pid'))
+
+    def test_unknown_entries_load_every_field(self):
+        self.assertEqual(only_plan(Book, ['title', '__unicode__']), None)
+        self.assertEqual(only_plan(Book, ['title', lambda obj: obj.bid]),
+                         None)
+
+class TestAutoBrowseOnlyFields(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        class PersonAdmin(AutoBrowseModelAdmin):
+            list_display = ['name', related_list(Person, 'bibliography')]
+
+        self.model_admin = PersonAdmin(Person, test_site)
+
+    def test_only_fields(self):
+        self.assertEqual(self.model_admin.only_fields, ('name', 'pid'))
+
+    def test_columns_do_not_load_deferred_fields(self):
+        qs = self.model_admin.apply_changelist_plan(Person.objects.all())
+        people = list(qs)
+        column = self.model_admin.list_display[2]
+        render = lambda: column.render_many(people) and \
+                         [person.name for person in people]
+        self.assertEqual(count_queries(render), 1)
+
+    def test_annotated_changelist_loads_every_field(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', 'author',
+                            link_to_changelist(Book, 'categories', count=True),
+                            related_list(Book, 'categories', sortable=True)]
+
+        model_admin = BookAdmin(Book, test_site)
+        self.assertEqual(model_admin.only_fields, None)
+        for query_string in ['', 'o=4&ot=desc']:
+            cl = make_changelist(model_admin, query_string)
+            self.assertEqual(len(cl.result_list), 6)
+            for book in cl.result_list:
+                expected = Book.objects.get(pk=book.pk)
+                self.assertEqual((book.title, book.author_id),
+                                 (expected.title, expected.author_id))
+                self.assertEqual(book._adminbrowse_categories_count,
+                                 expected.categories.count())
+                self.assertEqual(cl.list_display[4](book),
+                                 related_list(Book, 'categories')(expected))
+
+class TestDatabaseTruncatedField(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.column = truncated_field(Person, 'website', 24, in_database=True)
+
+        class PersonAdmin(AutoBrowseModelAdmin):
+            list_display = ['name', self.column]
+
+        self.model_admin = PersonAdmin(Person, test_site)
+
+    def test_field_is_not_required(self):
+        self.assertEqual(self.column.required_fields, [])
+        self.assertEqual(self.model_admin.only_fields, ('name',))
+
+    def test_extra_select(self):
+        self.assertEqual(self.model_admin.extra_select.keys(),
+                         [self.column.substr_name])
+
+    def test_renders_from_substring(self):
+        qs = self.model_admin.apply_changelist_plan(Person.objects.all())
+        people = list(qs.order_by('pk'))
+        self.assertEqual(len(getattr(people[2], self.column.substr_name)),
+                         25)
+        render = lambda: self.assertEqual(self.column.render_many(people),
+            [u"http://example.com/twain", u"", u"http://example.com/vonne…"])
+        self.assertEqual(count_queries(render), 0)
+
+    def test_falls_back_to_field(self):
+        people = Person.objects.order_by('pk')
+        self.assertEqual(self.column(people[2]),
+                         u"http://example.com/vonne…")
+        self.assertEqual(self.column(people[0]), u"http://example.com/twain")
+
+class TestChangeListPlan(TestCase):
+    def setUp(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            actions = None
+            list_display = ['title', 'author', 'loc_url']
+
+        self.BookAdmin = BookAdmin
+        clear_changelist_plans()
+
+    def test_does_not_modify_class_list_display(self):
+        self.BookAdmin(Book, test_site)
+        self.assertEqual(self.BookAdmin.list_display,
+                         ['title', 'author', 'loc_url'])
+
+    def test_plan_is_shared_between_instances(self):
+        first = self.BookAdmin(Book, test_site)
+        second = self.BookAdmin(Book, test_site)
+        self.assertTrue(first.changelist_plan is second.changelist_plan)
+        self.assertTrue(first.list_display[1] is second.list_display[1])
+
+    def test_plan_depends_on_admin_site(self):
+        first = self.BookAdmin(Book, test_site)
+        second = self.BookAdmin(Book, admin.AdminSite('other'))
+        self.assertFalse(first.changelist_plan is second.changelist_plan)
+
+    def test_plan_is_immutable(self):
+        plan = self.BookAdmin(Book, test_site).changelist_plan
+        self.assertRaises(AttributeError, setattr, plan, 'only_fields', None)
+        self.assertTrue(isinstance(plan.list_display, tuple))
+
+class TestLazyMetadata(TestCase):
+    def test_construction_does_not_resolve_field(self):
+        column = link_to_change(Book, 'no_such_field')
+        self.assertFalse('field' in column.__dict__)
+        self.assertRaises(AttributeError, getattr, column, 'field')
+
+    def test_metadata_is_resolved_on_first_use(self):
+        column = related_list(Person, 'bibliography')
+        self.assertEqual(column.short_description, u"bibliography")
+        self.assertEqual(column.to_model, Book)
+        self.assertEqual(column.rel_name, 'pid')
+        self.assertTrue('field' in column.__dict__)
+
+    def test_given_short_description_is_kept(self):
+        column = link_to_change(Book, 'author', short_description="by")
+        self.assertEqual(column.short_description, "by")
+        self.assertEqual(column.admin_order_field, 'author')
+
+    def test_concurrent_resolution(self):
+        column = link_to_changelist(Genre, 'collection', count=True)
+        results = []
+
+        def use_column():
+            results.append((column.field, column.view_name,
+                            column.annotations.keys()))
+
+        threads = [Thread(target=use_column) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set([id(field) for field, v, a in results])), 1)
+        self.assertEqual(set([(v, tuple(a)) for f, v, a in results]),
+                         set([(column.view_name, (column.count_name,))]))
+
+class TestSortableCounts(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def test_sortable_count_is_annotated_and_ordered(self):
+        column = link_to_changelist(Person, 'bibliography', count=True,
+                                    sortable=True)
+        self.assertEqual(column.admin_order_field, column.count_name)
+        people = Person.objects.annotate(**column.annotations)
+        people = people.order_by('-' + column.admin_order_field)
+        self.assertEqual([person.pk for person in people], [2, 3, 1])
+
+    def test_counts_are_not_sortable_by_default(self):
+        column = link_to_changelist(Person, 'bibliography', count=True)
+        self.assertEqual(column.admin_order_field, None)
+
+    def test_sortable_related_list(self):
+        column = related_list(Genre, 'collection', max_items=1,
+                              sortable=True)
+        genre = Genre.objects.annotate(**column.annotations).get(pk=1)
+        column.prefetch([genre])
+        self.assertEqual(column.admin_order_field, column.count_name)
+        self.assertEqual(column.get_known_count(genre),
+                         genre.collection.count())
+
+    def test_counter_field(self):
+        column = link_to_changelist(Person, 'bibliography',
+                                    counter_field='book_count')
+        self.assertEqual(column.admin_order_field, 'book_count')
+        self.assertFalse(hasattr(column, 'annotations'))
+        self.assertEqual(column.required_fields, ['pid', 'book_count'])
+        people = list(Person.objects.order_by('pk'))
+        render = lambda: self.assertEqual(map(column.get_count, people),
+                                          [0, 3, 2])
+        self.assertEqual(count_queries(render), 0)
+
+    def test_related_list_uses_counter_field(self):
+        column = related_list(Person, 'bibliography', max_items=1,
+                              counter_field='book_count')
+        people = list(Person.objects.order_by('pk'))
+        self.assertEqual(count_queries(column.prefetch, people), 1)
+
+class TestRelatedCountTracker(TestCase):
+    fixtures = ['test_adminbrowse.json']
+
+    def book_counts(self, model):
+        return list(model.objects.order_by('pk').values_list('book_count',
+                                                             flat=True))
+
+    def test_fixture_counts(self):
+        self.assertEqual(self.book_counts(Person), [0, 3, 2])
+        self.assertEqual(self.book_counts(Genre),
+                         [genre.collection.count()
+                          for genre in Genre.objects.order_by('pk')])
+
+    def test_foreign_key_changes(self):
+        book = Book.objects.get(pk=1)
+        book.author = Person.objects.get(pk=1)
+        book.save()
+        self.assertEqual(self.book_counts(Person), [1, 2, 2])
+        Book.objects.create(title="New", author_id=3)
+        self.assertEqual(self.book_counts(Person), [1, 2, 3])
+        book.delete()
+        self.assertEqual(self.book_counts(Person), [0, 2, 3])
+
+    def test_many_to_many_changes(self):
+        genre = Genre.objects.get(pk=1)
+        book = Book.objects.get(pk=6)
+        book.categories.clear()
+        book.categories.add(genre)
+        self.assertEqual(Genre.objects.get(pk=1).book_count,
+                         genre.collection.count())
+        genre.collection.clear()
+        self.assertEqual(self.book_counts(Genre)[0], 0)
+        genre.collection.add(book)
+        self.assertEqual(self.book_counts(Genre)[0], 1)
+        Book.objects.get(pk=5).delete()
+        self.assertEqual(self.book_counts(Genre),
+                         [genre.collection.count()
+                          for genre in Genre.objects.order_by('pk')])
+
+class TestUpdateAllCounts(TestCase):
+    fixtures = ['test_adminbrowse.json']
+
+    def test_counter_field_is_updated_per_chunk(self):
+        tracker = count_trackers[0]
+        Person.objects.update(book_count=7)
+        update = lambda: tracker.update_all(chunk_size=2)
+        # Two queries for the keys and two UPDATEs, for three people.
+        self.assertEqual(count_queries(update), 4)
+        self.assertEqual(list(Person.objects.order_by('pk').values_list(
+            'book_count', flat=True)), [0, 3, 2])
+
+    def test_store_is_updated_per_chunk(self):
+        RelatedCount.objects.all().delete()
+        bibliography_counts.update([2])
+        update = lambda: bibliography_counts.update_all(chunk_size=2)
+        # A query for the keys, a count, a DELETE and the INSERTs per chunk.
+        self.assertEqual(count_queries(update), 8)
+        self.assertEqual(bibliography_counts.get_counts([1, 2, 3]),
+                         {1: 0, 2: 3, 3: 2})
+
+class TestCustomThroughCounts(TestCase):
+    fixtures = ['test_adminbrowse.json']
+
+    def test_intermediary_objects_are_counted(self):
+        shelf = Shelf.objects.create(label="Favourites")
+        first = Placement.objects.create(shelf=shelf, book_id=1)
+        Placement.objects.create(shelf=shelf, book_id=2)
+        self.assertEqual(Shelf.objects.get(pk=shelf.pk).book_count, 2)
+        self.assertEqual(shelves_counts.get_counts([1, 2]), {1: 1, 2: 1})
+        first.book_id = 2
+        first.save()
+        self.assertEqual(shelves_counts.get_counts([1, 2]), {1: 0, 2: 2})
+        first.delete()
+        self.assertEqual(Shelf.objects.get(pk=shelf.pk).book_count, 1)
+        self.assertEqual(shelves_counts.get_counts([2]), {2: 1})
+
+    def test_deleting_related_object_is_counted(self):
+        shelf = Shelf.objects.create(label="Favourites")
+        Placement.objects.create(shelf=shelf, book_id=1)
+        Placement.objects.create(shelf=shelf, book_id=2)
+        Book.objects.get(pk=1).delete()
+        self.assertEqual(Shelf.objects.get(pk=shelf.pk).book_count, 1)
+        shelf.delete()
+        self.assertEqual(shelves_counts.get_counts([2]), {2: 0})
+
+class TestLazyTrackers(TestCase):
+    def test_relation_is_looked_up_when_an_instance_is_made(self):
+        tracker = store_related_count(Genre, 'collection')
+        try:
+            self.assertFalse(tracker.relation._resolved)
+            Genre(label="Poetry")
+            self.assertTrue(tracker.relation._resolved)
+        finally:
+            tracker.disconnect()
+            trackers.remove(tracker)
+
+class TestRelatedCountStore(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def test_counts_are_stored_as_objects_are_loaded(self):
+        self.assertEqual(bibliography_counts.get_counts([1, 2, 3]),
+                         {2: 3, 3: 2})
+        self.assertEqual(categories_counts.get_counts(range(1, 7)),
+                         {1: 1, 2: 1, 3: 1, 4: 2, 5: 2, 6: 0})
+
+    def test_counts_are_adjusted(self):
+        book = Book.objects.get(pk=1)
+        book.author_id = 3
+        book.save()
+        book.categories.add(Genre.objects.get(pk=5))
+        Book.objects.get(pk=4).categories.clear()
+        Genre.objects.get(pk=4).delete()
+        self.assertEqual(bibliography_counts.get_counts([2, 3]),
+                         {2: 2, 3: 3})
+        self.assertEqual(categories_counts.get_counts([1, 4, 5]),
+                         {1: 2, 4: 0, 5: 1})
+
+    def test_rebuild(self):
+        RelatedCount.objects.all().delete()
+        call_command('rebuild_related_counts', verbosity=0)
+        self.assertEqual(bibliography_counts.get_counts([1, 2, 3]),
+                         {1: 0, 2: 3, 3: 2})
+        self.assertEqual(Person.objects.get(pk=2).book_count, 3)
+
+    def test_column_reads_counts_in_bulk(self):
+        column = link_to_changelist(Person, 'bibliography',
+                                    count_store=bibliography_counts)
+        self.assertEqual(column.text, int)
+        self.assertFalse(hasattr(column, 'annotations'))
+        people = list(Person.objects.order_by('pk'))
+        self.assertEqual(count_queries(column.prefetch, people), 1)
+        render = lambda: self.assertEqual(map(column.get_count, people),
+                                          [0, 3, 2])
+        self.assertEqual(count_queries(render), 1)
+
+class TestCellCache(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.column = link_to_change(Book, 'author').cache_cells('title')
+
+    def test_uncached_column_renders(self):
+        column = link_to_change(Book, 'author')
+        books = list(Book.objects.all())
+        self.assertEqual(column.render_cached(books),
+                         column.render_many(books))
+
+    def test_cached_cells_are_not_rendered_again(self):
+        expected = self.column.render_many(list(Book.objects.all()))
+        books = list(Book.objects.all())
+        self.assertEqual(count_queries(self.column.render_cached, books), 1)
+        books = list(Book.objects.all())
+        render = lambda: self.assertEqual(self.column.render_cached(books),
+                                          expected)
+        self.assertEqual(count_queries(render), 0)
+
+    def test_new_version_is_rendered(self):
+        books = list(Book.objects.order_by('pk'))
+        self.column.render_cached(books)
+        books[0].title = "Changed"
+        books[0].author = Person.objects.get(pk=1)
+        books = [books[0]] + list(Book.objects.order_by('pk'))[1:]
+        self.assertTrue(u"Twain" in self.column.render_cached(books)[0])
+
+    def test_keys_depend_on_language(self):
+        books = list(Book.objects.all())
+        keys = self.column.get_cell_cache_keys(books)
+        activate('de')
+        try:
+            self.assertNotEqual(self.column.get_cell_cache_keys(books), keys)
+        finally:
+            deactivate()
+
+    def test_version_field_is_loaded(self):
+        self.assertEqual(only_plan(Book, [link_to_url(Book, 'loc_url')
+                                          .cache_cells('title')]),
+                         ('loc_url', 'title'))
+
+class TestPrepareColumns(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.columns = [related_list(Person, 'bibliography'),
+                        link_to_changelist(Person, 'bibliography'),
+                        link_to_url(Person, 'website')]
+        self.expected = [map(column, Person.objects.all())
+                         for column in self.columns]
+        self.people = list(Person.objects.all())
+
+    def test_fetch_phase_runs_the_queries(self):
+        renderers = []
+        prepare = lambda: renderers.extend(
+            prepare_columns(self.columns, self.people))
+        # related_list and link_to_changelist share the prefetched objects.
+        self.assertEqual(count_queries(prepare), 1)
+        render = lambda: self.assertEqual(
+            [render() for render in renderers], self.expected)
+        self.assertEqual(count_queries(render), 0)
+
+    def test_executor_map_is_used(self):
+        class Executor(object):
+            calls = []
+            def map(self, func, iterable):
+                self.calls.append(func)
+                return map(func, iterable)
+
+        executor = Executor()
+        renderers = prepare_columns(self.columns, self.people, executor)
+        self.assertEqual(len(executor.calls), 1)
+        self.assertEqual([render() for render in renderers], self.expected)
+
+    def test_cell_cache_misses_are_prefetched(self):
+        from django.core.cache import cache
+        cache.clear()
+        column = related_list(Person, 'bibliography').cache_cells('name')
+        column.render_cached(self.people[:1])
+        people = list(Person.objects.all())
+        render = column.prepare(people)
+        self.assertEqual(count_queries(render), 0)
+        self.assertEqual(render(), self.expected[0])
+
+class ThreadedPool(ThreadPool):
+    def use_threads(self, items):
+        return True
+
+class TestThreadPool(TestCase):
+    def setUp(self):
+        self.pool = ThreadedPool(3)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_map_returns_results_in_order(self):
+        self.assertEqual(self.pool.map(lambda x: x * 2, range(10)),
+                         range(0, 20, 2))
+
+    def test_map_runs_in_worker_threads(self):
+        from threading import currentThread
+        names = self.pool.map(lambda x: currentThread().getName(), range(6))
+        self.assertFalse(currentThread().getName() in names)
+        self.assertTrue(len(set(names)) <= 3)
+
+    def test_map_raises_task_exception(self):
+        def func(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+        self.assertRaises(ValueError, self.pool.map, func, range(4))
+        self.assertEqual(self.pool.map(func, [0, 1]), [0, 1])
+
+    def test_tasks_use_calling_thread_language(self):
+        activate('de')
+        try:
+            languages = self.pool.map(lambda x: get_language(), range(3))
+        finally:
+            deactivate()
+        self.assertEqual(languages, ['de'] * 3)
+
+    def test_workers_keep_connections_until_closed(self):
+        from threading import currentThread
+        from django.db import connections
+        pool = ThreadedPool(1)
+        wrapper_class = type(connections['default'])
+        close = wrapper_class.close
+        closed = []
+        wrapper_class.close = lambda self: closed.append(currentThread())
+        try:
+            pool.map(lambda x: x, [1, 2])
+            thread = pool._threads[0]
+            self.assertFalse(thread in closed)
+            pool.close()
+            thread.join()
+        finally:
+            wrapper_class.close = close
+        self.assertEqual(closed.count(thread), 1)
+
+    def test_in_memory_database_is_used_from_calling_thread(self):
+        if not has_thread_local_database():
+            return
+        pool = ThreadPool(3)
+        self.assertEqual(pool.map(lambda x: Person.objects.count(), [1, 2]),
+                         [Person.objects.count()] * 2)
+        self.assertEqual(pool._threads, [])
+
+class ExportPersonAdmin(admin.ModelAdmin):
+    list_display = ['action_checkbox', 'name',
+                    related_list(Person, 'bibliography'), 'emphasis']
+
+    def emphasis(self, obj):
+        return u"<em>%s</em> &amp; co." % obj.name
+    emphasis.allow_tags = True
+
+class TestExport(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        self.model_admin = ExportPersonAdmin(Person, test_site)
+        self.people = Person.objects.order_by('pk')
+
+    def test_rows_start_with_labels(self):
+        rows = export_rows(self.model_admin, self.people)
+        self.assertEqual(rows.next(), [u"name", u"bibliography",
+                                       u"Emphasis"])
+
+    def test_rows_contain_plain_text(self):
+        rows = list(export_rows(self.model_admin, self.people))
+        self.assertEqual(rows[1], [u"Mark Twain", u"",
+                                   u"Mark Twain & co."])
+        self.assertEqual(rows[3][1], u"Cat's Cradle, Slaughterhouse-Five")
+
+    def test_related_objects_are_prefetched_per_chunk(self):
+        rows = lambda: list(export_rows(self.model_admin, self.people,
+                                        chunk_size=2))
+        self.assertEqual(count_queries(rows), 3)
+        self.assertEqual(len(rows()), 4)
+
+    def test_auto_browse_columns_render_text(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', 'author']
+        model_admin = BookAdmin(Book, test_site)
+        rows = list(export_rows(model_admin, Book.objects.order_by('pk')))
+        self.assertEqual(rows[1], [u"For Whom the Bell Tolls",
+                                   u"Ernest Hemingway"])
+        self.assertEqual(rows[6], [u"English Dictionary", u""])
+
+    def test_booleans_and_empty_values_are_plain_text(self):
+        User.objects.create(username='staff', is_staff=True)
+
+        class UserAdmin(admin.ModelAdmin):
+            list_display = ['username', 'is_staff', 'is_superuser']
+        rows = list(export_rows(UserAdmin(User, test_site),
+                                User.objects.all()))
+        self.assertEqual(rows[1], [u"staff", u"True", u"False"])
+
+        class BookAdmin(admin.ModelAdmin):
+            list_display = ['title', 'author']
+        rows = list(export_rows(BookAdmin(Book, test_site),
+                                Book.objects.order_by('pk')))
+        self.assertEqual(rows[6], [u"English Dictionary", u""])
+
+    def test_csv_response(self):
+        response = export_as_csv(self.model_admin, None, self.people)
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=person.csv')
+        lines = response.content.splitlines()
+        self.assertEqual(lines[0], "name,bibliography,Emphasis")
+        self.assertEqual(lines[3], 'Kurt Vonnegut,'
+                         '"Cat\'s Cradle, Slaughterhouse-Five",'
+                         'Kurt Vonnegut & co.')
+
+    def test_json_response(self):
+        from django.utils import simplejson
+        response = export_response(self.model_admin, self.people, 'json',
+                                   chunk_size=1)
+        data = simplejson.loads(response.content)
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[0], [u"name", u"bibliography", u"Emphasis"])
+        self.assertEqual(data[1], [u"Mark Twain", u"", u"Mark Twain & co."])
+
+    def test_json_keeps_columns_with_repeated_labels(self):
+        from django.utils import simplejson
+        response = export_response(self.model_admin, self.people, 'json',
+                                   list_display=['name', 'name'])
+        data = simplejson.loads(response.content)
+        self.assertEqual(data[:2], [[u"name", u"name"],
+                                    [u"Mark Twain", u"Mark Twain"]])
+
+class TestExportConnection(TransactionTestCase):
+    fixtures = ['test_adminbrowse.json']
+
+    def test_connection_is_closed_after_streaming(self):
+        from django.db import connections
+        response = export_as_csv(ExportPersonAdmin(Person, test_site), None,
+                                 Person.objects.all())
+        wrapper_class = type(connections['default'])
+        close = wrapper_class.close
+        closed = []
+        wrapper_class.close = lambda self: closed.append(self.alias)
+        try:
+            content = iter(response)
+            content.next()
+            self.assertEqual(closed, [])
+            list(content)
+        finally:
+            wrapper_class.close = close
+        self.assertEqual(closed, ['default'])
+
+class TestKeysetPagination(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', 'author']
+            list_per_page = 2
+            keyset_pagination = True
+
+        self.model_admin = BookAdmin(Book, test_site)
+
+    def get_pages(self, query_string='', url_name='keyset_next_url'):
+        pages = []
+        while query_string is not None:
+            cl = make_changelist(self.model_admin, query_string)
+            self.assertTrue(cl.keyset_page)
+            pages.append([book.pk for book in cl.result_list])
+            query_string = getattr(cl, url_name)
+            if query_string is not None:
+                query_string = query_string[1:]
+        return pages
+
+    def test_keyset_lookup(self):
+        self.assertEqual(keyset_lookup(Book, 'bid'), ('pk', ['bid']))
+        self.assertEqual(keyset_lookup(Book, 'title'), ('title', ['title']))
+        self.assertEqual(keyset_lookup(Person, 'book_count'),
+                         ('book_count', ['book_count']))
+
+    def test_keyset_lookup_rejects_nullable_and_unknown_fields(self):
+        self.assertEqual(keyset_lookup(Book, 'author'), None)
+        self.assertEqual(keyset_lookup(Book, 'categories'), None)
+        self.assertEqual(keyset_lookup(Person, '_adminbrowse_count'), None)
+
+    def test_uses_adminbrowse_template(self):
+        self.assertEqual(self.model_admin.change_list_template,
+                         'adminbrowse/change_list.html')
+
+    def test_next_pages_follow_default_ordering(self):
+        self.assertEqual(self.get_pages(), [[6, 5], [4, 3], [2, 1]])
+
+    def test_next_pages_follow_column_ordering(self):
+        self.assertEqual(self.get_pages('o=1&ot=asc'),
+                         [[2, 4], [6, 1], [5, 3]])
+
+    def test_previous_pages(self):
+        cl = make_changelist(self.model_admin, 'o=1&ot=desc')
+        self.assertEqual(cl.keyset_first_url, None)
+        self.assertEqual(cl.keyset_previous_url, None)
+        while cl.keyset_next_url is not None:
+            cl = make_changelist(self.model_admin, cl.keyset_next_url[1:])
+        self.assertEqual([book.pk for book in cl.result_list], [4, 2])
+        pages = self.get_pages(cl.keyset_previous_url[1:],
+                               'keyset_previous_url')
+        self.assertEqual(pages, [[1, 6], [3, 5]])
+        self.assertEqual(self.get_pages(cl.keyset_first_url[1:])[0], [3, 5])
+
+    def test_nullable_ordering_uses_offset_pagination(self):
+        cl = make_changelist(self.model_admin, 'o=2')
+        self.assertFalse(cl.keyset_page)
+        self.assertEqual(len(cl.result_list), 2)
+
+    def test_count_ordering_uses_offset_pagination(self):
+        class PersonAdmin(AutoBrowseModelAdmin):
+            list_display = ['name', link_to_changelist(
+                Person, 'bibliography', count=True, sortable=True)]
+            list_per_page = 2
+            keyset_pagination = True
+
+        cl = make_changelist(PersonAdmin(Person, test_site), 'o=2&ot=desc')
+        self.assertFalse(cl.keyset_page)
+        self.assertEqual([person.pk for person in cl.result_list], [2, 3])
+
+    def test_invalid_cursor(self):
+        from django.contrib.admin.options import IncorrectLookupParameters
+        for query_string in ['after=x', 'after=%5B1%2C2%5D',
+                             'o=1&after=%5B%22a%22%5D']:
+            self.assertRaises(IncorrectLookupParameters, make_changelist,
+                              self.model_admin, query_string)
+
+    def test_results_suit_list_editable(self):
+        cl = make_changelist(self.model_admin, 'o=1&ot=asc')
+        self.assertTrue(cl.keyset_page)
+        FormSet = self.model_admin.get_changelist_formset(FakeRequest())
+        formset = FormSet(queryset=cl.result_list)
+        forms = lambda: [form.instance.pk for form in formset.forms]
+        self.assertEqual(count_queries(forms), 0)
+        self.assertEqual(forms(), [2, 4])
+
+def uses_sqlite():
+    return connection.settings_dict['ENGINE'].endswith('sqlite3')
+
+class TestResultCounts(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', 'author']
+            list_per_page = 2
+            result_count_mode = 'capped'
+            result_count_cap = 3
+
+        self.model_admin = BookAdmin(Book, test_site)
+
+    def test_approximate_count_display(self):
+        self.assertEqual(unicode(ApproximateCount(5)), u"5")
+        self.assertEqual(unicode(ApproximateCount(5, 'estimated')), u"~5")
+        self.assertEqual(str(ApproximateCount(5, 'at_least')), "5+")
+        self.assertEqual(ApproximateCount(5, 'at_least') + 1, 6)
+
+    def test_capped_count(self):
+        self.assertEqual(capped_count(Book.objects.all(), 10), 6)
+        self.assertEqual(capped_count(Book.objects.all(), 10).accuracy,
+                         'exact')
+        self.assertEqual(capped_count(Book.objects.all(), 6).accuracy,
+                         'exact')
+        count = capped_count(Book.objects.all(), 3)
+        self.assertEqual((count, count.accuracy), (3, 'at_least'))
+
+    def test_capped_changelist(self):
+        cl = make_changelist(self.model_admin)
+        self.assertEqual(unicode(cl.result_count), u"3+")
+        self.assertEqual(cl.paginator.accuracy, 'at_least')
+        self.assertEqual(cl.full_result_count, 3)
+        self.assertTrue(cl.multi_page)
+        self.assertFalse(cl.can_show_all)
+
+    def test_pages_past_capped_count(self):
+        cl = make_changelist(self.model_admin, 'p=2')
+        self.assertEqual([book.pk for book in cl.result_list], [2, 1])
+
+    def test_filtered_changelist_counts_filtered_objects(self):
+        cl = make_changelist(self.model_admin, 'author__pid__exact=3')
+        self.assertEqual(unicode(cl.result_count), u"2")
+        self.assertEqual(unicode(cl.full_result_count), u"3+")
+        self.assertFalse(cl.multi_page)
+
+class FakeRequest(object):
+    def __init__(self, query_string=''):
+        from django.http import QueryDict
+        self.GET = QueryDict(query_string)
+
+def make_changelist(model_admin, query_string=''):
+    if hasattr(model_admin, 'load_changelist_plan'):
+        model_admin.load_changelist_plan()
+    return BrowseChangeList(FakeRequest(query_string), model_admin.model,
+                            model_admin.list_display,
+                            model_admin.list_display_links,
+                            model_admin.list_filter,
+                            model_admin.date_hierarchy,
+                            model_admin.search_fields,
+                            model_admin.list_select_related,
+                            model_admin.list_per_page,
+                            model_admin.list_editable, model_admin)
+
+class TestListEditable(TestCase):
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        class PersonAdmin(AutoBrowseModelAdmin):
+            list_display = ['name', 'website',
+                            related_list(Person, 'bibliography')]
+            list_editable = ['website']
+
+        self.model_admin = PersonAdmin(Person, test_site)
+
+    def test_formset_uses_changelist_results(self):
+        request = FakeRequest()
+        cl = make_changelist(self.model_admin)
+        FormSet = self.model_admin.get_changelist_formset(request)
+        formset = FormSet(queryset=cl.result_list)
+        forms = lambda: [form.instance for form in formset.forms]
+        self.assertEqual(count_queries(forms), 0)
+        self.assertEqual(len(forms()), 3)
+
+class TestEstimatedCounts(TransactionTestCase):
+    # ANALYZE commits the transaction that a TestCase would roll back.
+    urls = 'adminbrowse.tests'
+    fixtures = ['test_adminbrowse.json']
+
+    def setUp(self):
+        class BookAdmin(AutoBrowseModelAdmin):
+            list_display = ['title', 'author']
+            list_per_page = 2
+            result_count_mode = 'estimated'
+            result_count_cap = 3
+
+        self.model_admin = BookAdmin(Book, test_site)
+        if uses_sqlite():
+            connection.cursor().execute("ANALYZE")
+
+    def tearDown(self):
+        if uses_sqlite():
+            connection.cursor().execute("DELETE FROM sqlite_stat1")
+            transaction.commit_unless_managed()
+
+    def test_estimate_count_reads_sqlite_statistics(self):
+        if not uses_sqlite():
+            return
+        count = estimate_count(Book)
+        self.assertEqual((count, count.accuracy), (6, 'estimated'))
+
+    def test_estimated_changelist(self):
+        if not uses_sqlite():
+            return
+        cl = make_changelist(self.model_admin)
+        self.assertEqual(unicode(cl.result_count), u"~6")
+        self.assertEqual(cl.paginator.accuracy, 'estimated')
+        self.assertEqual(cl.paginator.num_pages, 3)
+
+    def test_small_estimates_are_counted(self):
+        if not uses_sqlite():
+            return
+        self.model_admin.result_count_cap = 10
+        cl = make_changelist(self.model_admin)
+        self.assertEqual(unicode(cl.result_count), u"6")
+        self.assertEqual(cl.paginator.accuracy, 'exact')
+
+    def test_filtered_queryset_is_counted(self):
+        if not uses_sqlite():
+            return
+        class BookAdmin(AutoBrowseModelAdmin):
+            result_count_mode = 'estimated'
+            result_count_cap = 3
+
+            def queryset(self, request):
+                queryset = super(BookAdmin, self).queryset(request)
+                return queryset.filter(author__isnull=False)
+
+        cl = make_changelist(BookAdmin(Book, test_site))
+        self.assertEqual(unicode(cl.result_count), u"3+")
+        self.assertEqual(unicode(cl.full_result_count), u"3+")
+        self.assertEqual(cl.paginator.accuracy, 'at_least')
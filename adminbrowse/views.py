@@ -1 +1,174 @@
-# Create your views here.
+"""
+Streaming exports of changelists as CSV or JSON.
+
+Add `export_as_csv` or `export_as_json` to a `ModelAdmin`'s `actions` to
+export the selected objects with the columns in its `list_display`:
+
+    class BookAdmin(AutoBrowseModelAdmin):
+        list_display = ['title', related_list(Book, 'categories')]
+        actions = [export_as_csv, export_as_json]
+
+The objects are read with `QuerySet.iterator()` and rendered `chunk_size`
+at a time, prefetching what each chunk needs, and the response is
+generated as it is sent, so the memory used doesn't grow with the number of
+rows. Middleware that reads the whole response content (such as
+`GZipMiddleware`, or `CommonMiddleware` with `USE_ETAGS`) defeats this.
+The JSON export is an array of arrays: the column labels, then each row's
+values in the same order.
+
+"""
+import csv
+from cStringIO import StringIO
+
+from django.contrib.admin.util import (label_for_field, lookup_field,
+                                       display_for_field)
+from django.db import connections, transaction
+from django.db.models import BooleanField, NullBooleanField
+from django.http import HttpResponse
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+from django.utils.html import strip_tags
+from django.utils.translation import ugettext_lazy as _
+
+from adminbrowse.base import strip_entities
+
+
+def iter_chunks(queryset, chunk_size):
+    """
+    Yield lists of up to `chunk_size` objects from `queryset`, read with
+    `iterator()` so that the `QuerySet` doesn't cache them.
+
+    """
+    chunk = []
+    for obj in queryset.iterator():
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_export_columns(model_admin, list_display=None):
+    """
+    Return the entries of `list_display` (by default, the `ModelAdmin`'s)
+    to export, leaving out the action checkbox.
+
+    """
+    if list_display is None:
+        list_display = model_admin.list_display
+    return [column for column in list_display if column != 'action_checkbox']
+
+def render_text_column(column, objs, model_admin):
+    """
+    Return a list of the plain text content of the `list_display` entry
+    `column` for each object in `objs`.
+
+    """
+    if hasattr(column, 'render_text_many'):
+        return column.render_text_many(objs)
+    texts = []
+    for obj in objs:
+        field, attr, value = lookup_field(column, obj, model_admin)
+        if value is None:
+            text = u""
+        elif field is not None and not isinstance(field, (BooleanField,
+                                                          NullBooleanField)):
+            # display_for_field() shows booleans as icons.
+            text = display_for_field(value, field)
+        else:
+            text = force_unicode(value)
+            if getattr(attr, 'allow_tags', False):
+                text = strip_entities(strip_tags(text))
+        texts.append(force_unicode(text))
+    return texts
+
+def export_rows(model_admin, queryset, list_display=None, chunk_size=500):
+    """
+    Yield the header labels, then a list of the plain text content of each
+    column for each object in `queryset`. If `model_admin` has an
+    `apply_changelist_plan()` method (see `AutoBrowseModelAdmin`), it is
+    applied to `queryset` first.
+
+    """
+    if hasattr(model_admin, 'apply_changelist_plan'):
+        # This also puts the plan's columns in `list_display`.
+        queryset = model_admin.apply_changelist_plan(queryset)
+    columns = get_export_columns(model_admin, list_display)
+    yield [force_unicode(label_for_field(column, model_admin.model,
+                                         model_admin))
+           for column in columns]
+    for chunk in iter_chunks(queryset, chunk_size):
+        texts = [render_text_column(column, chunk, model_admin)
+                 for column in columns]
+        for row in zip(*texts):
+            yield list(row)
+
+def iter_csv(rows):
+    """Yield the given rows as lines of UTF-8 encoded CSV."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([text.encode('utf-8') for text in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def iter_json(rows):
+    """
+    Yield the parts of a JSON array with an array for each of the given
+    rows, so that the columns keep their order even if labels repeat.
+
+    """
+    yield '['
+    separator = '\n'
+    for row in rows:
+        yield separator + simplejson.dumps(row)
+        separator = ',\n'
+    yield '\n]\n'
+
+def close_connection_after(content, using):
+    """
+    Yield the items of `content`, then end the transaction on the database
+    connection `using` and close it. Django has already closed the request's
+    connections when a streamed response is sent, so reading from the
+    database while sending one opens a new connection that would otherwise
+    be left open.
+
+    """
+    try:
+        for item in content:
+            yield item
+    finally:
+        if not transaction.is_managed(using=using):
+            transaction.rollback_unless_managed(using=using)
+            connections[using].close()
+
+def export_response(model_admin, queryset, format='csv', list_display=None,
+                    chunk_size=500):
+    """
+    Return an `HttpResponse` that streams the export of `queryset` in the
+    given format ('csv' or 'json') as an attachment.
+
+    """
+    rows = export_rows(model_admin, queryset, list_display, chunk_size)
+    if format == 'csv':
+        content, mimetype = iter_csv(rows), 'text/csv; charset=utf-8'
+    elif format == 'json':
+        content, mimetype = iter_json(rows), 'application/json'
+    else:
+        raise ValueError("Unknown export format: %r" % format)
+    content = close_connection_after(content, queryset.db)
+    response = HttpResponse(content, mimetype=mimetype)
+    filename = '%s.%s' % (model_admin.model._meta.module_name, format)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+def export_as_csv(model_admin, request, queryset):
+    return export_response(model_admin, queryset, 'csv')
+export_as_csv.short_description = _("Export selected %(verbose_name_plural)s "
+                                    "as CSV")
+
+def export_as_json(model_admin, request, queryset):
+    return export_response(model_admin, queryset, 'json')
+export_as_json.short_description = _("Export selected "
+                                     "%(verbose_name_plural)s as JSON")
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Measure how adminbrowse changelist columns scale.
+
+Builds a synthetic dataset of the `Person`, `Genre` and `Book` test models in
+SQLite, then renders changelist pages that use each adminbrowse column type,
+both with a plain `ModelAdmin` and with `AutoBrowseModelAdmin`, recording the
+wall time and number of queries for each. For example:
+
+    $ python benchmark.py --books 100000 --fan-out 5 --output results.json
+
+Results are printed as a table and, with `--output`, written as JSON so runs
+against different releases can be compared.
+
+"""
+import os
+import sys
+import platform
+from optparse import OptionParser
+from timeit import default_timer
+
+from django.conf import settings
+
+# (scenario name, model name, list_display factory). The factories are called
+# with the `adminbrowse.tests` module, which defines the test models and
+# imports the column aliases, once Django is set up.
+SCENARIOS = [
+    ('link_to_change', 'Book',
+     lambda m: ['title', m.link_to_change(m.Book, 'author')]),
+    ('link_to_change_template', 'Book',
+     lambda m: ['title', type('TemplateLink', (m.link_to_change,),
+                              {'fast_render': False})(m.Book, 'author')]),
+    ('link_to_changelist', 'Person',
+     lambda m: ['name', m.link_to_changelist(m.Person, 'bibliography')]),
+    ('link_to_changelist_m2m', 'Genre',
+     lambda m: ['label', m.link_to_changelist(m.Genre, 'collection')]),
+    ('link_to_changelist_counter', 'Person',
+     lambda m: ['name', m.link_to_changelist(m.Person, 'bibliography',
+                                             counter_field='book_count')]),
+    ('related_list', 'Book',
+     lambda m: ['title', m.related_list(m.Book, 'categories')]),
+    ('link_to_url', 'Person',
+     lambda m: ['name', m.link_to_url(m.Person, 'website')]),
+    ('truncated_field', 'Book',
+     lambda m: ['bid', m.truncated_field(m.Book, 'title', 20)]),
+    ('auto', 'Book',
+     lambda m: ['title', 'author', 'loc_url']),
+    ('several_related', 'Book',
+     lambda m: ['title', m.link_to_change(m.Book, 'author'),
+                m.related_list(m.Book, 'categories'),
+                m.related_list(m.Book, 'categories', display_field='label',
+                               max_items=2),
+                m.link_to_changelist(m.Book, 'categories')]),
+]
+
+
+def configure(database):
+    settings.configure(
+        DEBUG=True,
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': database}},
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes',
+                        'django.contrib.admin', 'adminbrowse'],
+        ROOT_URLCONF='adminbrowse.tests',
+        ADMINBROWSE_MEDIA_URL='/media/adminbrowse/',
+    )
+
+def populate(models, books, authors, genres, fan_out, chunk_size=10000):
+    """Fill the test model tables with synthetic rows using raw inserts."""
+    from django.db import connection, transaction
+
+    def insert(table, columns, rows):
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(table), ', '.join([qn(column) for column in columns]),
+            ', '.join(['%s'] * len(columns)))
+        cursor = connection.cursor()
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                cursor.executemany(sql, chunk)
+                chunk = []
+        if chunk:
+            cursor.executemany(sql, chunk)
+
+    def field(model, name):
+        return model._meta.get_field(name)
+
+    Person, Genre, Book = models.Person, models.Genre, models.Book
+    insert(Person._meta.db_table,
+           [field(Person, 'pid').column, field(Person, 'name').column,
+            field(Person, 'website').column,
+            field(Person, 'book_count').column],
+           ((i, 'Author %d' % i, i % 2 and 'http://example.com/%d' % i or '',
+             0) for i in xrange(1, authors + 1)))
+    insert(Genre._meta.db_table,
+           [field(Genre, 'gid').column, field(Genre, 'label').column,
+            field(Genre, 'book_count').column],
+           ((i, 'Genre %d' % i, 0) for i in xrange(1, genres + 1)))
+    insert(Book._meta.db_table,
+           [field(Book, 'bid').column, field(Book, 'title').column,
+            field(Book, 'author').column, field(Book, 'loc_url').column],
+           ((i, 'Book number %d with a long title' % i,
+             i % 20 and i % authors + 1 or None,
+             'http://loc.example.com/%d' % i)
+            for i in xrange(1, books + 1)))
+    categories = field(Book, 'categories')
+    insert(categories.m2m_db_table(),
+           [categories.m2m_column_name(), categories.m2m_reverse_name()],
+           ((i, (i + j) % genres + 1) for i in xrange(1, books + 1)
+            for j in xrange(min(fan_out, genres))))
+    # Raw inserts don't send the signals that maintain the counters.
+    for tracker in models.count_trackers:
+        tracker.update_all()
+    transaction.commit_unless_managed()
+
+def render_page(model_admin, page):
+    """
+    Build the changelist for `model_admin` the way `changelist_view()` does
+    and render the header and result cells for the given page.
+
+    """
+    from django.http import HttpRequest, QueryDict
+    from django.contrib.admin.templatetags.admin_list import (results,
+                                                              result_headers)
+    request = HttpRequest()
+    request.GET = QueryDict('p=%d' % page)
+    if hasattr(model_admin, 'load_changelist_plan'):
+        model_admin.load_changelist_plan()
+    ChangeList = model_admin.get_changelist(request)
+    list_display = list(model_admin.list_display)
+    cl = ChangeList(request, model_admin.model, list_display,
+                    model_admin.list_display_links, model_admin.list_filter,
+                    model_admin.date_hierarchy, model_admin.search_fields,
+                    model_admin.list_select_related,
+                    model_admin.list_per_page, model_admin.list_editable,
+                    model_admin)
+    cl.formset = None
+    list(result_headers(cl))
+    return [list(row) for row in results(cl)]
+
+def counting_pool(workers):
+    """
+    Return a `ThreadPool` that adds the queries its worker threads execute
+    to its `queries` attribute, since `connection.queries` only lists those
+    of the current thread.
+
+    """
+    from threading import Lock, currentThread
+    from django.db import connection
+    from adminbrowse.executors import ThreadPool
+
+    class CountingThreadPool(ThreadPool):
+        def __init__(self, workers):
+            ThreadPool.__init__(self, workers)
+            self.queries = 0
+            self._count_lock = Lock()
+
+        def map(self, func, iterable):
+            caller = currentThread()
+            def counted(item):
+                if currentThread() is caller:
+                    return func(item)
+                start = len(connection.queries)
+                try:
+                    return func(item)
+                finally:
+                    self._count_lock.acquire()
+                    try:
+                        self.queries += len(connection.queries) - start
+                    finally:
+                        self._count_lock.release()
+            return ThreadPool.map(self, counted, iterable)
+
+    return CountingThreadPool(workers)
+
+def run_scenario(model_admin, page, repeat):
+    from django.db import connection, reset_queries
+    executor = getattr(model_admin, 'column_executor', None)
+    timings = []
+    queries = 0
+    for i in xrange(repeat):
+        reset_queries()
+        if hasattr(executor, 'queries'):
+            executor.queries = 0
+        start = default_timer()
+        rows = render_page(model_admin, page)
+        timings.append(default_timer() - start)
+        queries = len(connection.queries) + getattr(executor, 'queries', 0)
+    timings.sort()
+    return {'rows': len(rows), 'queries': queries, 'min': timings[0],
+            'median': timings[len(timings) // 2], 'max': timings[-1]}
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]", description=__doc__.split(
+        '\n\n')[1].replace('\n', ' '))
+    parser.add_option('--books', type='int', default=1000,
+                      help="number of books to create [%default]")
+    parser.add_option('--authors', type='int', default=None,
+                      help="number of people to create [books / 10]")
+    parser.add_option('--genres', type='int', default=50,
+                      help="number of genres to create [%default]")
+    parser.add_option('--fan-out', type='int', default=3,
+                      help="number of genres per book [%default]")
+    parser.add_option('--page', type='int', default=0,
+                      help="zero-based changelist page to render [%default]")
+    parser.add_option('--per-page', type='int', default=100,
+                      help="rows per changelist page [%default]")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="times to render each page [%default]")
+    parser.add_option('--scenario', action='append', dest='scenarios',
+                      help="only run the named scenario (may be repeated)")
+    parser.add_option('--database', default=':memory:',
+                      help="SQLite database file [in memory]")
+    parser.add_option('--threads', type='int', default=0,
+                      help="prepare AutoBrowseModelAdmin columns on this many "
+                           "threads; needs --database [%default]")
+    parser.add_option('--output', help="write JSON results to this file")
+    options, args = parser.parse_args(argv)
+    authors = options.authors or max(options.books // 10, 1)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    configure(options.database)
+    from django.core.management import call_command
+    from django.contrib.admin import ModelAdmin
+    from django.utils import simplejson
+    import django
+    from adminbrowse import AutoBrowseModelAdmin
+    from adminbrowse import tests as models
+    call_command('syncdb', interactive=False, verbosity=0)
+
+    start = default_timer()
+    populate(models, options.books, authors, options.genres, options.fan_out)
+    populate_time = default_timer() - start
+
+    results = []
+    for name, model_name, list_display in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+        model = getattr(models, model_name)
+        for admin_class in [ModelAdmin, AutoBrowseModelAdmin]:
+            attrs = {'list_display': list_display(models),
+                     'list_per_page': options.per_page}
+            if options.threads and admin_class is AutoBrowseModelAdmin:
+                attrs['column_executor'] = counting_pool(options.threads)
+            Admin = type(model_name + admin_class.__name__, (admin_class,),
+                         attrs)
+            result = run_scenario(Admin(model, models.test_site),
+                                  options.page, options.repeat)
+            result.update(scenario=name, model_admin=admin_class.__name__)
+            results.append(result)
+            print "%-24s %-22s %5d rows %6d queries %9.2f ms" % (
+                name, admin_class.__name__, result['rows'], result['queries'],
+                result['median'] * 1000)
+
+    if options.output:
+        report = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'dataset': {'books': options.books, 'authors': authors,
+                        'genres': options.genres,
+                        'fan_out': options.fan_out,
+                        'populate_seconds': populate_time},
+            'page': options.page, 'per_page': options.per_page,
+            'repeat': options.repeat, 'threads': options.threads,
+            'results': results,
+        }
+        output = open(options.output, 'w')
+        try:
+            simplejson.dump(report, output, indent=2)
+        finally:
+            output.close()
+
+if __name__ == '__main__':
+    main()
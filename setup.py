@@ -5,7 +5,8 @@ from setuptools import setup, find_packages
 setup(
     name = "django-adminbrowse",
     version = "0.1.2",
-    packages = ['adminbrowse'],
+    packages = ['adminbrowse', 'adminbrowse.management',
+                'adminbrowse.management.commands'],
     include_package_data = True,
     author = "Brian Beck",
     author_email = "exogen@gmail.com",